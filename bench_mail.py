@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+Memory benchmark of e-mail composition in sendphotos.Sending.
+
+Compares peak Python memory of building the whole message in memory (create_message)
+with writing it to a spool file (spool_message), for a growing number of photo attachments.
+Usage: ./bench_mail.py [photo size in kB] [max number of attachments]
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import time
+
+import yaml
+
+import photologging
+from sendphotos import Sending
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    start = time()
+    result = function(*args)
+    elapsed = time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+
+def main(photo_kb=1500, max_photos=9):
+    path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(path, "photoconfig.yaml"), 'r') as stream:
+        config = yaml.full_load(stream)
+    # the log lines of every message would bury the table
+    config.setdefault('logging', {})['console'] = False
+    photologging.configure(console=False)
+    workdir = tempfile.mkdtemp()
+    try:
+        config['paths']['photopath'] = workdir
+        config['paths']['queue'] = os.path.join(workdir, 'queue.db')
+        sending = Sending(config)
+        photos = []
+        for num in range(max_photos):
+            name = "photo%d.jpg" % num
+            with open(os.path.join(workdir, name), 'wb') as photo:
+                photo.write(os.urandom(photo_kb * 1024))
+            photos.append(name)
+        print("%6s %14s %14s %10s %10s" % ("photos", "in memory [MB]", "spooled [MB]", "mem [s]", "spool [s]"))
+        for count in range(1, max_photos + 1):
+            composed, peak_memory, time_memory = measure(sending.create_message, "bench@example.com", photos[:count])
+            del composed
+            with tempfile.TemporaryFile(dir=workdir) as spool:
+                size, peak_spool, time_spool = measure(sending.spool_message, "bench@example.com",
+                                                       photos[:count], spool)
+            print("%6d %14.2f %14.2f %10.3f %10.3f" % (count, peak_memory / 2.0 ** 20, peak_spool / 2.0 ** 20,
+                                                       time_memory, time_spool))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]])
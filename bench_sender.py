@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+Throughput benchmark of sendphotos.Sending against a local SMTP stand-in.
+
+Starts an SMTP sink in this process (plain SMTP with AUTH PLAIN, accepting any login), which can add latency
+to every reply, drop the connection after a share of messages and refuse a share of recipients.
+For every sender configuration (number of workers, messages per connection, size cap) a backlog of N recipients
+with noise JPEGs of the size of the e-mail copies is put into a fresh send queue, and a sender process
+drains it. Reports messages and bytes per second, peak RSS of the sender and the retries, failures
+and quarantines.
+Usage: ./bench_sender.py --recipients 50 --photos 3 --workers 1 2 4 --latency 0.05 --disconnect 0.05 --refuse 0.02
+'''
+
+import argparse
+import copy
+import io
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socketserver
+import tempfile
+import threading
+from time import sleep, time
+
+from PIL import Image
+
+import photoconf
+import photologging
+from sendqueue import SendQueue
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    ''' one SMTP session of the sink; settings are taken from the server '''
+
+    def reply(self, line):
+        if self.server.latency:
+            sleep(self.server.latency)
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command.split(' ')[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250-sink\r\n250-AUTH PLAIN\r\n250 8BITMIME')
+            elif verb == 'AUTH':
+                self.reply('235 accepted')
+            elif verb == 'MAIL':
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                if random.random() < self.server.refuse:
+                    self.server.count('refused')
+                    self.reply('451 try again later' if random.random() < 0.5 else '550 no such user')
+                else:
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    size += len(data)
+                if random.random() < self.server.disconnect:
+                    self.server.count('disconnected')
+                    return
+                self.server.count('messages')
+                self.server.count('bytes', size)
+                self.reply('250 queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class Sink(socketserver.ThreadingTCPServer):
+    ''' SMTP stand-in counting what it receives '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, disconnect=0.0, refuse=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SinkHandler)
+        self.latency = latency
+        self.disconnect = disconnect
+        self.refuse = refuse
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            (counts, self.counts) = (self.counts, {})
+        return counts
+
+
+def make_backlog(config, recipients, photos, size):
+    ''' fills a new send queue with sessions of noise JPEGs, each with its own recipient '''
+    img = Image.merge('RGB', [Image.effect_noise(tuple(size), 40) for _ in range(3)])
+    stream = io.BytesIO()
+    img.save(stream, 'JPEG', quality=85)
+    jpeg = stream.getvalue()
+    queue = SendQueue(config['paths']['queue'])
+    for directory in (config['paths']['photopath'], config['paths']['emailcopies']):
+        os.makedirs(directory)
+    for number in range(recipients):
+        session = queue.open_session()
+        for photo in range(photos):
+            name = "%04d_%d.jpg" % (number, photo)
+            with open(os.path.join(config['paths']['emailcopies'], name), 'wb') as copy_file:
+                copy_file.write(jpeg)
+            queue.add_photo(session, name)
+        queue.add_recipient(session, "visitor%04d@example.com" % number)
+    return len(jpeg)
+
+
+def drain(config, results):
+    ''' runs in a separate process, so the peak RSS belongs to the sender alone '''
+    import sendphotos
+    from photometrics import metrics
+    sending = sendphotos.Sending(config)
+    queue = SendQueue(config['paths']['queue'])
+    start = time()
+    threading.Thread(target=sending.run, daemon=True).start()
+    while True:
+        sleep(0.05)
+        unsent = queue.connection().execute("SELECT COUNT(*) FROM recipients WHERE state IN ('pending', 'sending')"
+                                            ).fetchone()[0]
+        if not unsent:
+            break
+    elapsed = time() - start
+    states = dict(queue.connection().execute("SELECT state, COUNT(*) FROM recipients GROUP BY state").fetchall())
+    results.put({'elapsed': elapsed, 'states': states, 'counters': dict(metrics.counters),
+                 'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sender throughput benchmark against a local SMTP sink")
+    parser.add_argument('--recipients', type=int, default=50)
+    parser.add_argument('--photos', type=int, default=3, help="photos per recipient")
+    parser.add_argument('--size', type=int, nargs=2, default=[1280, 768], help="size of the attached JPEGs")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--max-messages', type=int, nargs='+', default=[50], help="messages per connection")
+    parser.add_argument('--max-message-bytes', type=int, nargs='+', default=[20971520])
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before every reply of the sink")
+    parser.add_argument('--disconnect', type=float, default=0.0, help="share of messages dropped by the sink")
+    parser.add_argument('--refuse', type=float, default=0.0, help="share of recipients refused, half 4xx, half 5xx")
+    parser.add_argument('--retry-delay', type=float, default=0.1)
+    args = parser.parse_args()
+
+    base = copy.deepcopy(photoconf.load())
+    base['smtp'].update(host='127.0.0.1', tls='plain', quiet_window=0, retry_delay=args.retry_delay,
+                        retry_max_delay=args.retry_delay * 8, connect_max_delay=1, stats_interval=3600)
+    base['storage']['interval'] = 3600
+    base['metrics']['interval'] = 0
+    base['logging']['console'] = False
+    photologging.configure(console=False)
+
+    sink = Sink(args.latency, args.disconnect, args.refuse)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    base['smtp']['port'] = sink.server_address[1]
+
+    print("%7s %8s %7s %8s %8s %8s %8s  %s" % ("workers", "max_msgs", "cap MB", "msg/s", "MB/s", "RSS MB",
+                                               "retries", "recipients; sink"))
+    for (workers, max_messages, cap) in [(w, m, c) for w in args.workers for m in args.max_messages
+                                         for c in args.max_message_bytes]:
+        workdir = tempfile.mkdtemp()
+        try:
+            config = copy.deepcopy(base)
+            for key in ['photopath', 'addr', 'metrics']:
+                config['paths'][key] = os.path.join(workdir, key)
+            config['paths']['emailcopies'] = os.path.join(workdir, 'photopath', 'email')
+            config['paths']['queue'] = os.path.join(workdir, 'addr', 'queue.db')
+            config['paths']['handoff'] = os.path.join(workdir, 'addr', 'sender.sock')
+            config['smtp'].update(workers=workers, max_messages=max_messages, max_message_bytes=cap)
+            make_backlog(config, args.recipients, args.photos, args.size)
+            sink.reset()
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=drain, args=(config, results))
+            process.start()
+            result = results.get()
+            process.join()
+        finally:
+            shutil.rmtree(workdir)
+        counts = sink.reset()
+        elapsed = result['elapsed']
+        print("%7d %8d %7.1f %8.1f %8.2f %8.1f %8d  %s; %d drops, %d refusals" % (
+            workers, max_messages, cap / 1048576.0, counts.get('messages', 0) / elapsed,
+            counts.get('bytes', 0) / 1048576.0 / elapsed, result['rss'] / 1024.0,
+            result['counters'].get('emails_retried', 0),
+            ", ".join("%s %d" % x for x in sorted(result['states'].items())),
+            counts.get('disconnected', 0), counts.get('refused', 0)))
+
+
+if __name__ == '__main__':
+    main()
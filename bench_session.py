@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end session benchmark of the photobooth on the simulated hardware.
+
+Runs complete sessions (prep_and_photo and finishing) with "backend: sim" and a scaled clock,
+for every combination of the prep_delay, total_pics, noprev and capture mode values given, and reports sessions
+per hour, the median lag between the end of the countdown and the photo, and the time spent in each stage. Times are virtual: delays count as requested, work as measured.
+Stages are nested (e.g. take_photo is part of taking_photo), so their shares do not add up to 100%.
+Usage: ./bench_session.py --sessions 3 --scale 20 --prep-delay 1 3 --total-pics 3 --noprev 1 0 --capture-mode still fixed
+'''
+
+import argparse
+import copy
+import itertools
+import os
+import shutil
+import tempfile
+
+import yaml
+
+import photologging
+from boothclock import clock
+from photobooth import Photo
+from photometrics import metrics
+
+PHOTO_STAGES = ['wait_for_press', 'taking_photo']
+CAMERA_STAGES = ['take_photo', 'overlay_image', 'img_preview']
+
+
+def timed(stats, name, function):
+    def wrapper(*args, **kwargs):
+        start = clock.now()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats[name] = stats.get(name, 0.0) + clock.now() - start
+    return wrapper
+
+
+def run(config, sessions):
+    photo = Photo(config=config)
+    stats = {}
+    for name in PHOTO_STAGES:
+        setattr(photo, name, timed(stats, name, getattr(photo, name)))
+    for name in CAMERA_STAGES:
+        setattr(photo.camera, name, timed(stats, name, getattr(photo.camera, name)))
+    for name in ['prep_and_photo', 'finishing']:
+        setattr(photo, name, timed(stats, name, getattr(photo, name)))
+    start = clock.now()
+    for _ in range(sessions):
+        photo.prep_and_photo()
+        photo.finishing()
+    elapsed = clock.now() - start
+    photo.close()
+    return elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="photobooth session benchmark on simulated hardware")
+    parser.add_argument('--sessions', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=20, help="how many times shorter the delays are")
+    parser.add_argument('--press-delays', type=float, nargs='+', default=[5, 20],
+                        help="seconds before the visitor presses the button: at the intro and after the e-mail")
+    parser.add_argument('--prep-delay', type=float, nargs='+', default=[3])
+    parser.add_argument('--total-pics', type=int, nargs='+', default=[3])
+    parser.add_argument('--noprev', type=int, nargs='+', default=[1])
+    parser.add_argument('--capture-mode', nargs='+', default=['still'], choices=['still', 'video', 'fixed'])
+    parser.add_argument('--mode-switch-time', type=float, default=0.4,
+                        help="seconds a simulated still capture spends switching the sensor mode")
+    args = parser.parse_args()
+
+    path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(path, "photoconfig.yaml"), 'r') as stream:
+        base = yaml.full_load(stream)
+    base['backend'] = 'sim'
+    base['autopress'] = False
+    base['sim']['time_scale'] = args.scale
+    base['sim']['press_delays'] = args.press_delays
+    base['sim']['mode_switch_time'] = args.mode_switch_time
+    base.setdefault('logging', {})['console'] = False
+    photologging.configure(console=False)
+
+    print("%10s %10s %6s %7s %10s %10s %8s  %s" % ("prep_delay", "total_pics", "noprev", "capture", "session s",
+                                                   "sessions/h", "lag ms", "stages: s per session (share)"))
+    for (prep_delay, total_pics, noprev, mode) in itertools.product(args.prep_delay, args.total_pics, args.noprev,
+                                                                    args.capture_mode):
+        workdir = tempfile.mkdtemp()
+        try:
+            config = copy.deepcopy(base)
+            config['prep_delay'] = prep_delay
+            config['total_pics'] = total_pics
+            config['camera']['noprev'] = bool(noprev)
+            config['camera']['capture_mode'] = mode
+            # any sensor mode counts as fixed in the simulation
+            config['camera']['sensor_mode'] = config['camera'].get('sensor_mode') or 1
+            metrics.histograms.pop('shutter_lag_' + mode, None)
+            for key in ['photopath', 'addr', 'emailcopies', 'metrics']:
+                config['paths'][key] = os.path.join(workdir, key)
+            config['paths']['queue'] = os.path.join(workdir, 'addr', 'queue.db')
+            elapsed, stats = run(config, args.sessions)
+        finally:
+            shutil.rmtree(workdir)
+        per_session = elapsed / args.sessions
+        lag = metrics.histograms['shutter_lag_' + mode].summary()['p50']
+        stages = ", ".join("%s %.2f (%d%%)" % (name, stats[name] / args.sessions, 100 * stats[name] / elapsed)
+                           for name in ['prep_and_photo', 'finishing'] + PHOTO_STAGES + CAMERA_STAGES
+                           if name in stats)
+        print("%10.1f %10d %6d %7s %10.2f %10.1f %8.0f  %s" % (prep_delay, total_pics, noprev, mode, per_session,
+                                                               3600 / per_session, lag * 1000, stages))
+
+
+if __name__ == '__main__':
+    main()
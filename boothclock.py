@@ -0,0 +1,76 @@
+'''
+Clock used for all the delays of the photobooth.
+
+On the booth it is the wall clock. In a simulation (backend "sim") the delays can be shortened by a scale factor,
+so a session that takes a minute for a visitor can be benchmarked in seconds. Time spent on actual work
+is not scaled: only the delays of the driving thread (the one running the session) move the virtual
+clock ahead of the wall clock.
+'''
+
+import threading
+import time
+
+
+class Clock:
+    ''' wall clock whose delays can be scaled down
+
+    Attributes
+    ------------
+    scale : float
+        how many times shorter than requested the delays are
+    skipped : float
+        virtual seconds the driving thread did not have to wait
+    driver : threading.Thread
+        thread whose delays move the virtual clock, None for the wall clock
+
+    Methods
+    ------------
+    set_scale(scale)
+        changes the scale and makes the calling thread the driving one
+    now()
+        returns the virtual time in seconds
+    sleep(seconds)
+        sleeps for virtual seconds
+    wait(event, timeout=None)
+        waits for threading.Event at most timeout virtual seconds; returns whether the event is set
+    '''
+
+    def __init__(self):
+        self.scale = 1.0
+        self.skipped = 0.0
+        self.driver = None
+
+    def set_scale(self, scale):
+        self.scale = float(scale)
+        self.driver = threading.current_thread() if scale != 1 else None
+
+    def now(self):
+        return time.time() + self.skipped
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        time.sleep(seconds / self.scale)
+        if threading.current_thread() is self.driver:
+            self.skipped += seconds - seconds / self.scale
+
+    def wait(self, event, timeout=None):
+        start = time.time()
+        if timeout is None:
+            result = event.wait()
+        else:
+            result = event.wait(max(0.0, timeout) / self.scale)
+        if threading.current_thread() is self.driver:
+            self.skipped += (time.time() - start) * (self.scale - 1)
+        return result
+
+
+clock = Clock()
+
+
+def sleep(seconds):
+    clock.sleep(seconds)
+
+
+def now():
+    return clock.now()
@@ -0,0 +1,155 @@
+'''
+Background generation of e-mail sized copies and filtered variants of the captured photos.
+
+Copies are made in a separate process, so decoding and encoding of the JPEGs never competes
+with the countdown and capture in the photobooth process. The workers do not log themselves,
+they return what is logged by the photobooth process.
+'''
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from PIL import Image
+
+from photologging import Logging
+
+log = Logging()
+
+
+def make_derivative(source, target, size, quality):
+    ''' writes a downscaled JPEG copy of the source; runs in a worker process
+
+    Parameters
+    ------------
+    source : str
+        path of the captured photo
+    target : str
+        path of the copy
+    size : (int, int)
+        maximum width and height of the copy
+    quality : int
+        JPEG quality of the copy
+    '''
+    img = Image.open(source)
+    # the JPEG decoder can scale down by 1/2, 1/4 or 1/8 while decoding
+    img.draft('RGB', tuple(size))
+    img.thumbnail(tuple(size), Image.LANCZOS)
+    tmp = target + '.tmp'
+    img.save(tmp, 'JPEG', quality=quality)
+    os.replace(tmp, target)
+    return target
+
+
+def make_variants(source, names, threads, quality, copydir, size, copy_quality):
+    ''' writes the filtered variants of the photo and their e-mail sized copies; runs in a worker process
+
+    Returns
+    (list, str)
+        paths of the variants and the line to be logged
+    '''
+    # NumPy is needed only when the filters are rendered after the capture
+    import photofilters
+    start = time()
+    targets = photofilters.render_variants(source, names, quality, threads)
+    if copydir:
+        for target in targets:
+            make_derivative(target, os.path.join(copydir, os.path.basename(target)), size, copy_quality)
+    return (targets, "%d variants of %s in %.3f s" % (len(targets), os.path.basename(source), time() - start))
+
+
+def lower_priority():
+    # initializer of every worker process, so none of them competes with the GUI
+    os.nice(10)
+
+
+class DerivativeMaker:
+    ''' makes e-mail sized copies of the photos in a process pool
+
+    Attributes
+    ------------
+    config : dict
+        "email_copy" part of the config: enabled, size, quality and workers
+    copydir : str
+        directory for the copies, files have the same names as the photos
+    filters : list
+        names of the filters rendered after the capture by submit_variants
+    filter_threads : int
+        number of threads rendering the variants of one photo
+    filter_quality : int
+        JPEG quality of the variants
+    executor : concurrent.futures.ProcessPoolExecutor
+        pool of worker processes
+
+    Methods
+    ------------
+    start()
+        starts the worker processes
+    submit(photopath)
+        queues making the copy of the photo and returns at once
+    submit_variants(photopath, callback=None)
+        queues rendering of the filtered variants of the photo, callback(paths) is called when they are written,
+        with no paths when the rendering failed
+    close()
+        waits for the queued copies and stops the workers
+    '''
+
+    def __init__(self, config, copydir, filters=None, filter_threads=4, filter_quality=90):
+        self.config = config
+        self.copydir = copydir
+        self.filters = filters or []
+        self.filter_threads = filter_threads
+        self.filter_quality = filter_quality
+        self.executor = None
+        if not os.path.exists(self.copydir):
+            os.makedirs(self.copydir)
+
+    def start(self):
+        if not self.config.get('enabled', True) and not self.filters:
+            return
+        # the log writer, config watcher and handoff threads already run here, a forked worker would get
+        # their locks in any state; a fork server started from a clean process makes the workers instead
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['derivatives'])
+        self.executor = ProcessPoolExecutor(max_workers=self.config.get('workers', 1), mp_context=context,
+                                            initializer=lower_priority)
+        # the workers start now rather than with the first photo
+        for _ in range(self.config.get('workers', 1)):
+            self.executor.submit(os.getpid)
+
+    def submit(self, photopath):
+        if not self.executor or not self.config.get('enabled', True):
+            return None
+        target = os.path.join(self.copydir, os.path.basename(photopath))
+        future = self.executor.submit(make_derivative, photopath, target,
+                                      self.config['size'], self.config['quality'])
+        future.add_done_callback(self.done)
+        return future
+
+    def submit_variants(self, photopath, callback=None):
+        if not self.executor or not self.filters:
+            return None
+        copydir = self.copydir if self.config.get('enabled', True) else None
+        future = self.executor.submit(make_variants, photopath, self.filters, self.filter_threads,
+                                      self.filter_quality, copydir, self.config['size'], self.config['quality'])
+
+        def variants_done(future):
+            paths = []
+            if future.exception():
+                log.append("filtered variants failed: " + " ".join(str(future.exception()).splitlines()))
+            else:
+                (paths, line) = future.result()
+                log.append(line)
+            if callback:
+                callback(paths)
+        future.add_done_callback(variants_done)
+        return future
+
+    def done(self, future):
+        if future.exception():
+            log.append("e-mail copy failed: " + " ".join(str(future.exception()).splitlines()))
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
@@ -0,0 +1,137 @@
+'''
+Watching a directory for new files.
+
+Uses Linux inotify through ctypes, so names of files are delivered as soon as they are closed after writing
+or moved into the directory. When inotify is not available, the directory is polled with os.listdir.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+from queue import Queue, Empty
+from time import sleep
+
+from photologging import Logging
+
+log = Logging()
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def inotify_libc():
+    ''' returns libc with inotify functions or None if inotify is not available '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirWatcher:
+    ''' watches a directory and pushes names of new and rewritten files into a queue
+
+    Attributes
+    ------------
+    path : str
+        watched directory
+    poll_interval : float
+        time in seconds between directory scans when inotify is not available
+    mask : int
+        inotify events reported for the files in the directory
+    queue : queue.Queue
+        names of the files ready to be read
+    fd : int
+        inotify file descriptor, None when polling
+
+    Methods
+    ------------
+    start()
+        starts watching in a background thread and queues the files already present in the directory
+    get(timeout=None)
+        returns the next file name or None after timeout
+    put(name)
+        queues the name again, e.g. to retry it later
+    rescan()
+        queues all the files present in the directory
+    '''
+
+    def __init__(self, path, poll_interval=0.5, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.mask = mask
+        self.queue = Queue()
+        self.fd = None
+        self.seen = {}
+
+    def start(self):
+        libc = inotify_libc()
+        if libc:
+            fd = libc.inotify_init1(IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(self.path), self.mask) >= 0:
+                self.fd = fd
+            elif fd >= 0:
+                os.close(fd)
+        if self.fd is None:
+            log.append("inotify not available, polling " + self.path)
+            target = self.poll
+        else:
+            log.append("watching " + self.path)
+            target = self.read_events
+        # the scan comes after the watch is set, so files written in between are not missed
+        self.rescan()
+        threading.Thread(target=target, daemon=True).start()
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def put(self, name):
+        self.queue.put(name)
+
+    def rescan(self):
+        for name in self.listdir():
+            self.queue.put(name)
+
+    def listdir(self):
+        found = {}
+        for name in os.listdir(self.path):
+            try:
+                found[name] = os.path.getmtime(os.path.join(self.path, name))
+            except OSError:
+                continue
+        self.seen = found
+        return sorted(found, key=found.get)
+
+    def read_events(self):
+        while True:
+            data = os.read(self.fd, 64 * (EVENT_HEADER.size + 256))
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    log.append("inotify queue overflow, rescanning")
+                    self.rescan()
+                elif name:
+                    self.queue.put(os.fsdecode(name))
+
+    def poll(self):
+        while True:
+            sleep(self.poll_interval)
+            previous = self.seen
+            for name in self.listdir():
+                if previous.get(name) != self.seen[name]:
+                    self.queue.put(name)
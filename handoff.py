@@ -0,0 +1,221 @@
+'''
+Handoff of the e-mail addresses from the photobooth to the sender over a Unix domain socket.
+
+Every message is a JSON object preceded by its length as a 4-byte big-endian number, and every message
+is answered with {"ok": true} once the receiver has stored it, or {"ok": false, "error": ...}.
+The client sends from its own thread, so the GUI never waits for the socket or the disk. When the sender
+is not running or does not answer, the client stores the message itself with the fallback function.
+A message can be submitted as a function returning it, called in that thread, so the GUI does not wait
+for the photos still being made either.
+'''
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from time import time
+
+from photologging import Logging
+
+log = Logging()
+
+HEADER = struct.Struct('>I')
+MAX_FRAME = 1024 * 1024
+
+
+def send_frame(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed")
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if size > MAX_FRAME:
+        raise ValueError("frame of %d bytes" % size)
+    return json.loads(recv_exactly(sock, size).decode('utf-8'))
+
+
+class HandoffHandler(socketserver.BaseRequestHandler):
+    ''' one connection of a client: stores every message with the handler of the server and acknowledges it '''
+
+    def handle(self):
+        while True:
+            try:
+                message = recv_frame(self.request)
+            except (EOFError, OSError):
+                return
+            except ValueError as e:
+                log.append("bad handoff frame: " + str(e))
+                return
+            try:
+                self.server.handler(message)
+                reply = {'ok': True}
+            except Exception as e:
+                log.append("handoff not stored: " + " ".join(str(e).splitlines()))
+                reply = {'ok': False, 'error': str(e)}
+            send_frame(self.request, reply)
+
+
+class HandoffServer(socketserver.ThreadingUnixStreamServer):
+    ''' receives the messages on the Unix socket in background threads
+
+    Attributes
+    ------------
+    path : str
+        location of the socket
+    handler : callable
+        handler(message) stores the message, an exception makes the reply negative
+
+    Raises
+    ------------
+    OSError
+        when the socket cannot be bound or another sender is listening on it
+
+    Methods
+    ------------
+    start()
+        starts serving in a background thread
+    close()
+        stops serving and removes the socket
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                # left by a sender that was killed
+                os.remove(path)
+            else:
+                raise OSError("%s is used by another sender" % path)
+            finally:
+                probe.close()
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, HandoffHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        log.append("handoff socket " + self.path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class HandoffClient:
+    ''' sends the messages to the sender from a background thread, with a fallback when it is not there
+
+    Attributes
+    ------------
+    path : str
+        location of the socket of the sender
+    fallback : callable
+        fallback(message) stores the message without the sender
+    timeout : float
+        seconds of waiting for the connection and the acknowledgement
+    messages : queue.Queue
+        messages waiting to be sent
+
+    Methods
+    ------------
+    submit(message)
+        queues the message, or a function returning it, and returns at once
+    flush()
+        waits until all the queued messages are stored
+    close()
+        sends the queued messages and stops the thread
+    '''
+
+    def __init__(self, path, fallback, timeout=2.0):
+        self.path = path
+        self.fallback = fallback
+        self.timeout = timeout
+        self.messages = queue.Queue()
+        self.sock = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, message):
+        self.messages.put(message)
+
+    def flush(self):
+        self.messages.join()
+
+    def connect(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+        return self.sock
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, message):
+        # a connection kept from the previous message may have been closed by a restarted sender
+        for retry in (True, False):
+            try:
+                sock = self.connect()
+                send_frame(sock, message)
+                return recv_frame(sock)
+            except (OSError, EOFError, ValueError):
+                self.disconnect()
+                if not retry:
+                    raise
+
+    def run(self):
+        while True:
+            message = self.messages.get()
+            try:
+                if message is None:
+                    self.disconnect()
+                    return
+                if callable(message):
+                    message = message()
+                start = time()
+                try:
+                    reply = self.send(message)
+                except (OSError, EOFError, ValueError) as e:
+                    reply = {'ok': False, 'error': str(e)}
+                if reply.get('ok'):
+                    log.append("handed off to the sender in %.1f ms" % ((time() - start) * 1000))
+                    continue
+                log.append("sender did not take the handoff (%s), stored directly" % reply.get('error'))
+                try:
+                    self.fallback(message)
+                except Exception as e:
+                    log.append("handoff lost: " + " ".join(str(e).splitlines()))
+            finally:
+                self.messages.task_done()
+
+    def close(self):
+        self.messages.put(None)
+        self.thread.join()
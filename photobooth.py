@@ -1,17 +1,31 @@
 #!/usr/bin/python3
 
+from startup import timer
 import datetime
+import io
 import os
-from time import sleep
+import threading
+from time import time
 
-import yaml
-
-from photoutils import PushButton, LedButton, Camera
+from boothclock import clock
+from derivatives import DerivativeMaker
+from handoff import HandoffClient
+from photoutils import PushButton, LedButton, Camera, use_backend
+from photowriter import PhotoWriter
+import photoconf
+import photologging
+import photometrics
 from photologging import Logging
+from photometrics import metrics, timed
+from sendqueue import SendQueue
 
 log = Logging()
 
 
+class SessionAborted(Exception):
+    ''' raised inside the session when Photo.abort() is called '''
+
+
 class Photo:
     ''' A class that implements a photobooth on RaspberryPi with PushButton and PiCamera
 
@@ -22,6 +36,20 @@ class Photo:
             self.photopaths = []
         photopaths : list
             list of strings with paths of images captured in the current run
+        variants : list
+            events set once the filtered variants of each photo of the current run are saved, in "post" filter mode
+        variantpaths : list
+            paths of the filtered variants of the current run, once they are rendered
+        queue : SendQueue
+            queue of sessions and recipients shared with sendphotos.py
+        session : int
+            id of the current session in the queue
+        handoff : HandoffClient
+            hands the e-mail addresses to the sender in background
+        derivatives : DerivativeMaker
+            makes e-mail sized copies of the photos in background
+        writer : PhotoWriter
+            writes the photos captured to memory in background, None when captured straight to files
         ledbutton : LedButton
             instance of photoutils.LedButton class, handling the LED behaviour
         pressbutton : PushButton
@@ -29,12 +57,32 @@ class Photo:
         camera : Camera
             instance of photoutils.Camera class, handles the needed camera display methods
 
+    The session is a state machine: intro -> startup -> capture -> email -> processing -> finish.
+    Every state is a method returning the name of the next state. Delays are cancellable timers
+    and button presses are awaited events, so abort() ends the session at once.
+
     Methods:
     ------------
     wait_for_press(im1='', im2='')
         waits for button press with LED blinking and alternating images on display
     taking_photo(num=1, iffilter=False)
         sets the image target file name and captures the image
+    hand_off(email)
+        queues the current session for sending to the address without waiting
+    config_changed(changed)
+        applies the settings changed in photoconfig.yaml while running
+    photo_saved(filepath)
+        adds the photo written to file to the session and queues its e-mail copy and filtered variants
+    show(im, layer=3)
+        shows the image as the current screen, replacing the previous one
+    delay(seconds)
+        waits the time unless the session is aborted
+    run_states(state, last)
+        runs the states from state until last is done
+    abort()
+        ends the current session and returns to the intro screen
+    stop()
+        ends the current session and makes prep_and_photo and finishing return without starting another one
     prep_and_photo
         displays all the intro images, captures photos, sets camera preview transparent and waits for button press
     finishing
@@ -47,12 +95,11 @@ class Photo:
     def __init__(self, config=None):
         log.append("starting")
         if not config:
-            with open("photoconfig.yaml", 'r') as stream:
-                config = yaml.full_load(stream)
-        self.config = config
-        realpath = os.path.dirname(os.path.realpath(__file__))
-        for (key, val) in self.config['paths'].items():
-            self.config['paths'][key] = os.path.join(realpath, val)
+            config = photoconf.load()
+            photoconf.watch()
+            timer.mark("config load")
+        self.config = photoconf.resolve_paths(photoconf.validate(config))
+        photologging.configure(**self.config['logging'])
         if not os.path.exists(self.config['paths']['photopath']):
             print(self.config['paths']['photopath'])
             os.makedirs(self.config['paths']['photopath'])
@@ -61,14 +108,59 @@ class Photo:
             print(self.config['paths']['addr'])
             os.makedirs(self.config['paths']['addr'])
 
+        photometrics.start_export(self.config.get('metrics', {}), 'photobooth', self.config['paths']['metrics'])
+        self.queue = SendQueue(self.config['paths']['queue'])
+        # the queue is written directly only when the sender does not take the address
+        self.handoff = HandoffClient(self.config['paths']['handoff'], self.handoff_failed,
+                                     self.config['gui'].get('handoff_timeout', 2))
+        camera = self.config['camera']
+        # "post" filter mode: photos are captured unfiltered and filtered variants are rendered afterwards
+        self.postfilter = camera.get('filter_mode', 'live') == 'post'
+        self.derivatives = DerivativeMaker(self.config['email_copy'], self.config['paths']['emailcopies'],
+                                           camera.get('post_filters', []) if self.postfilter else [],
+                                           camera.get('filter_threads', 4), camera.get('filter_quality', 90))
+        self.derivatives.start()
+        self.writer = None
+        if self.config['camera'].get('capture_to_memory', False):
+            self.writer = PhotoWriter(self.config['camera'].get('write_queue', 3),
+                                      self.config['camera'].get('fsync', True))
+            self.writer.start()
+        self.session = None
         self.photopaths = []
+        self.variants = []
+        self.variantpaths = []
+        backend = self.config.get('backend', 'pi')
+        use_backend(backend, self.config.get('sim'))
+        if backend == 'sim':
+            # sessions are run by the thread creating Photo, its delays drive the clock
+            clock.set_scale(self.config['sim'].get('time_scale', 1))
         self.ledbutton = LedButton(buttonbcm=self.config['pin_arcade_led'])
         self.pressbutton = PushButton(buttonbcm=self.config['pin_camera_btn'],
-                                      autopress=self.config['autopress'])
+                                      autopress=self.config['autopress'],
+                                      debounce=self.config.get('debounce', 0.02))
+        timer.mark("GPIO setup")
         self.camera = Camera(self.config['camera'])
-        self.finishov = False
+        timer.mark("camera init")
+        # intro images are needed first, the rest is decoded in the background
+        paths = self.config['paths']
+        self.camera.preload_overlays([paths['introimg1'], paths['introimg2']], paths.values())
+        self.screen = None
+        self.state = 'idle'
+        self.aborted = threading.Event()
+        self.closed = False
+        photoconf.subscribe(self.config_changed)
+        self.handlers = {'intro': self.intro, 'startup': self.startup, 'capture': self.capture,
+                         'email': self.email, 'processing': self.processing, 'finish': self.finish}
 
-    def wait_for_press(self, im1='', im2='',ov=False):
+    def config_changed(self, changed):
+        # the other live settings are read from self.config when they are used
+        self.pressbutton.debounce = self.config['debounce']
+        if self.postfilter:
+            # the maker keeps its own list, apply() puts a new one into the config
+            self.derivatives.filters = self.config['camera'].get('post_filters', [])
+
+    @timed('wait_for_press')
+    def wait_for_press(self, im1='', im2=''):
         ''' waits for button press with LED blinking and alternating images on display
 
         Parameters
@@ -76,33 +168,33 @@ class Photo:
         im1 : str, optional
             path for image to be displayed on lower layer
         im2 : str, optional
-            path for image to be displayed on upper layer
+            path for image to be displayed on upper layer, left as the screen after the press
         '''
 
-        ov1 = None
         ov2 = None
         if im1:
-            ov1 = self.camera.overlay_image(im1, 0, 3)
-            self.camera.remove_overlay(ov)
+            self.show(im1, 3)
         if im2:
             ov2 = self.camera.overlay_image(im2, 0, 4)
+        if not timer.reported:
+            timer.mark("first overlay visible")
+            timer.report()
         self.pressbutton.detect_press()
-        while not self.pressbutton.waspressed:
-            if ov2:
-                ov2.alpha = 255
-            self.ledbutton.turn_on(1)
-            if ov2:
-                ov2.alpha = 0
-            sleep(1)
-        if ov1:
-            self.camera.remove_overlay(ov1)
+        # the upper image is visible while the LED is on
+        self.ledbutton.blink(1, 1, callback=lambda on: self.camera.set_overlay_visible(ov2, on))
+        self.pressbutton.wait()
+        self.ledbutton.stop()
+        if self.aborted.is_set():
+            self.camera.remove_overlay(ov2)
+            raise SessionAborted()
         if ov2:
-            ov2.alpha = 255
-            return ov2
-        return None
+            self.camera.set_overlay_visible(ov2, True)
+            self.camera.remove_overlay(self.screen)
+            self.screen = ov2
+        log.append("press to reaction %.0f ms" % ((time() - self.pressbutton.pressed_at) * 1000))
 
-
-    def taking_photo(self, num=1, iffilter=False, ov=False):
+    @timed('taking_photo')
+    def taking_photo(self, num=1, iffilter=False):
         '''sets the image target file name and captures the image
 
         Parameters
@@ -119,66 +211,201 @@ class Photo:
         self.photopaths.append(filepath)
         # prep delay
         grnum = 1 if num==1 else (3 if num == self.config['total_pics'] else 2)
-        ov1=self.camera.overlay_image(self.config['paths']['getready'] + str(grnum) + ".png")
-        if ov:
-            self.camera.remove_overlay(ov)
-        sleep(self.config['prep_delay'])
-        self.camera.remove_overlay(ov1)
+        self.show(self.config['paths']['getready'] + str(grnum) + ".png")
+        self.delay(self.config['prep_delay'])
+        self.camera.remove_overlay(self.screen)
+        self.screen = None
         # photo
-        self.camera.take_photo(filepath, iffilter)
-        with open(self.config['paths']['piclist'], 'a') as addrfile:
-            addrfile.write(filename + '\r\n')
+        if self.writer:
+            stream = io.BytesIO()
+            self.camera.take_photo(stream, iffilter)
+            self.writer.put(filepath, stream.getvalue(), self.photo_saved)
+        else:
+            self.camera.take_photo(filepath, iffilter)
+            self.photo_saved(filepath)
+        metrics.inc('photos')
+        # short LED flash off, played in background
+        self.ledbutton.play([(0, 0.2), (1, 0)])
+
+    def photo_saved(self, filepath):
+        # called only once the file is complete, from the writer thread when capturing to memory
+        self.derivatives.submit(filepath)
+        self.queue.add_photo(self.session, os.path.basename(filepath))
+        if self.postfilter:
+            # the variants are added to this session even when the next one has started meanwhile
+            (session, variantpaths, saved) = (self.session, self.variantpaths, threading.Event())
+
+            def variants_saved(paths):
+                for path in paths:
+                    self.queue.add_photo(session, os.path.basename(path))
+                variantpaths.extend(paths)
+                saved.set()
+            if self.derivatives.submit_variants(filepath, variants_saved):
+                self.variants.append(saved)
         log.append("Photo saved: " + filepath)
-        self.ledbutton.turn_off(0.2)
+        if not self.config['camera']['noprev']:
+            self.camera.make_preview(filepath)
 
-    def prep_and_photo(self):
+    def hand_off(self, email):
+        # called from the GUI thread, so the socket and the queue are used from the handoff thread
+        (session, photopaths, variantpaths, variants) = (self.session, list(self.photopaths), self.variantpaths,
+                                                         list(self.variants))
+
+        def message():
+            # the session is claimable only with all its variants, the handoff thread waits for them
+            start = time()
+            for saved in variants:
+                saved.wait()
+            if variants:
+                log.append("%d filtered variants saved, waited %.0f ms" % (len(variantpaths),
+                                                                           (time() - start) * 1000))
+            return {'session': session, 'email': email,
+                    'photos': [os.path.basename(x) for x in photopaths + variantpaths]}
+        self.handoff.submit(message)
+
+    def handoff_failed(self, message):
+        self.queue.add_recipient(message['session'], message['email'], message['photos'])
+        metrics.inc('handoff_fallbacks')
+
+    def show(self, im, layer=3):
+        # the new screen is shown before the previous one is removed, so nothing flickers
+        overlay = self.camera.overlay_image(im, 0, layer)
+        self.camera.remove_overlay(self.screen)
+        self.screen = overlay
+        return overlay
+
+    def delay(self, seconds):
+        if clock.wait(self.aborted, seconds):
+            raise SessionAborted()
+
+    def abort(self):
+        log.append("abort requested")
+        self.aborted.set()
+        self.pressbutton.release()
+
+    def run_states(self, state, last):
+        '''runs the states from state until last is done
+
+        Returns
+        bool
+            False if the session was aborted
+        '''
+        try:
+            while state and not self.closed:
+                self.state = state
+                log.append("state " + state)
+                following = self.handlers[state]()
+                if state == last:
+                    break
+                state = following
+            return True
+        except SessionAborted:
+            log.append("session aborted in state " + self.state)
+            self.ledbutton.stop()
+            self.camera.remove_overlay(self.screen)
+            self.screen = None
+            self.camera.set_opaque()
+            self.aborted.clear()
+            return False
+        finally:
+            self.state = 'idle'
+
+    def intro(self):
         log.append("Press the button to take a photo")
-        ov2=self.wait_for_press(im1=self.config['paths']['introimg1'], im2=self.config['paths']['introimg2'], ov=self.finishov)
+        self.wait_for_press(im1=self.config['paths']['introimg1'], im2=self.config['paths']['introimg2'])
         log.append("pressed")
         self.ledbutton.turn_on()
+        return 'startup'
+
+    def startup(self):
         log.append("fraktal")
-        ov1=self.camera.overlay_image(im=self.config['paths']['startup2'])
-        self.camera.remove_overlay(ov2)
-        sleep(self.config['startup_delay'])
+        self.show(self.config['paths']['startup2'])
+        self.delay(self.config['startup_delay'])
         log.append("starting")
-        ov2=self.camera.overlay_image(im=self.config['paths']['startup1'])
-        self.camera.remove_overlay(ov1)
-        sleep(self.config['startup_delay'])
-        log.append("clearing tmp photo locations file")
-        if os.path.exists(self.config['paths']['piclist']):
-            os.rename(self.config['paths']['piclist'],
-                      self.config['paths']['garbage'] + str(datetime.datetime.now()).split('.')[0])
-        self.photopaths=[]
-        self.taking_photo(1, ov=ov2)
-        for photo_number in range(2, self.config['total_pics'] + 1):
-            self.taking_photo(num=photo_number, iffilter=True)
+        self.show(self.config['paths']['startup1'])
+        self.delay(self.config['startup_delay'])
+        return 'capture'
+
+    def capture(self):
+        log.append("new session")
+        # a previous session left without e-mail is abandoned and cleaned up by the sender
+        self.session = self.queue.open_session()
+        self.photopaths = []
+        # variants still rendered for an aborted session are added to it and left to the reaper
+        self.variants = []
+        self.variantpaths = []
+        self.camera.clear_previews()
+        metrics.inc('sessions')
+        # all the photos of the session have the same exposure in the "fixed" capture mode
+        self.camera.lock_exposure()
+        try:
+            self.taking_photo(1)
+            for photo_number in range(2, self.config['total_pics'] + 1):
+                self.taking_photo(num=photo_number, iffilter=not self.postfilter)
+        finally:
+            self.camera.unlock_exposure()
+        if self.writer:
+            # all the photos are in the queue before the visitor can leave the e-mail address
+            self.writer.flush()
+            (written, removed) = self.writer.reset_stats()
+            log.append("%d photos written in background, %.0f ms taken off the shots" % (written, removed * 1000))
+        if not self.config['camera']['noprev'] and self.config['camera'].get('preview_grid', False):
+            self.camera.make_grid(self.photopaths)
+        return 'email'
+
+    def email(self):
         log.append("email instructions")
-        self.camera.overlay_image(self.config['paths']['email_image'], self.config['timeout_email'])
+        self.show(self.config['paths']['email_image'])
+        self.delay(self.config['timeout_email'])
+        self.camera.remove_overlay(self.screen)
+        self.screen = None
         log.append("full transparency to get email")
         self.camera.set_transparent()
         log.append("waits for press")
         self.wait_for_press()
         # after press, email is gathered and control goes to finishing
+        return 'processing'
 
-    def finishing(self):
+    def processing(self):
         self.ledbutton.turn_on()
         log.append("processing")
-        ov1=self.camera.overlay_image(im=self.config['paths']['processingimg'])
-        sleep(self.config['startup_delay'])
+        self.show(self.config['paths']['processingimg'])
+        self.delay(self.config['startup_delay'])
         self.camera.set_opaque()
         log.append("preview")
         self.camera.img_preview(self.photopaths)
+        return 'finish'
+
+    def finish(self):
         log.append("finish img")
-        self.finishov=self.camera.overlay_image(self.config['paths']['finished_image'])
-        self.camera.remove_overlay(ov1)
-        sleep(self.config['finish_time'])
+        # the "thank you" screen stays until the next intro
+        self.show(self.config['paths']['finished_image'])
+        self.delay(self.config['finish_time'])
+        log.append(self.camera.cache.stats())
         log.append("All done!")
+        return None
+
+    def prep_and_photo(self):
+        while not self.run_states('intro', 'email') and not self.closed:
+            log.append("starting over")
+
+    def finishing(self):
+        self.run_states('processing', 'finish')
+
+    def stop(self):
+        self.closed = True
+        self.abort()
 
     def close(self):
         log.append("logfile closed")
+        self.stop()
         self.ledbutton.close()
         self.pressbutton.close()
         self.camera.close()
+        if self.writer:
+            self.writer.close()
+        self.handoff.close()
+        self.derivatives.close()
 
     def main(self):
         while True:
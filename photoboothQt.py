@@ -1,17 +1,21 @@
 #!/usr/bin/python3
-import os
+from startup import timer
+import signal
 import sys
+from time import time
 
-import yaml
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QThread, QTimer, QRect, QSize, pyqtSignal
+from PyQt5.QtGui import QColor, QFont, QPainter, QPixmap
 from PyQt5.QtWidgets import QPushButton, QVBoxLayout, QHBoxLayout, QSizePolicy
 from PyQt5.QtWidgets import QWidget, QLineEdit
 
-import photobooth
+import photoconf
 from photologging import Logging
+from photometrics import metrics
 
 log = Logging()
+timer.mark("imports")
 
 
 class FotoThread(QThread):
@@ -21,37 +25,165 @@ class FotoThread(QThread):
     def __init__(self, config=None):
         QThread.__init__(self)
         self.exiting = False
-        self.photo = photobooth.Photo(config=config)
+        self.config = config
+        self.photo = None
         log.append("photothread init")
 
     def run(self):
         log.append("PhotoThread run")
+        # camera, GPIO and PIL are imported and initialised here, while the GUI is being shown
+        import photobooth
+        timer.mark("photobooth imported")
+        self.photo = photobooth.Photo(config=self.config)
         while not self.exiting:
             log.append("photobooth loop")
             # takes photo, sets camera transparency and waits for button press
             # button is pressed after user enters email
             self.photo.prep_and_photo()
+            if self.exiting:
+                break
             # button pressed
             self.signal.emit()
             # email is being collected now
             # displays "thank you" etc
             self.photo.finishing()
+        # the hardware is released by the thread using it, once no state runs
+        self.photo.close()
 
     def stop(self):
         self.exiting = True
-        self.photo.close()
-        self.exiting = True
+        if self.photo:
+            self.photo.stop()
         self.wait()
 
+
+class KeyboardWidget(QWidget):
+    ''' on-screen keyboard painted as a single widget
+
+    All the keys are drawn once into a pixmap for the precomputed layout, a paint event copies the pixmap
+    and highlights the pressed key. Touches are hit-tested against the key rectangles.
+
+    Attributes
+    ------------
+    keys : list
+        rows of key labels, an empty label is a gap
+    rects : list
+        (label, QRect) of every key for the current size
+    pixmap : QPixmap
+        keyboard with no key pressed
+    pressed : int
+        index of the pressed key in rects, or None
+    pressed_at : float
+        time of the last press, until it is painted
+    created : float
+        time when the widget was created, until the first frame is painted
+
+    Methods
+    ------------
+    arrange(size)
+        computes the key rectangles and paints the pixmap for the size
+    key_at(pos)
+        returns the index of the key at the position, or None
+    '''
+
+    keyPressed = pyqtSignal(str)
+    FOREGROUND = QColor('white')
+    BACKGROUND = QColor('black')
+    HIGHLIGHT = QColor(80, 80, 80)
+
+    def __init__(self, keys, screen_wh, parent=None):
+        QWidget.__init__(self, parent)
+        self.created = time()
+        self.keys = keys
+        self.keyfont = QFont('Arial')
+        self.keyfont.setPixelSize(44)
+        self.keyfont.setBold(True)
+        self.rects = []
+        self.pixmap = None
+        self.pressed = None
+        self.pressed_at = None
+        # the widget paints every pixel itself
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.setMinimumHeight(screen_wh[1] * len(keys) // 6)
+        self.arrange(QSize(screen_wh[0], screen_wh[1] * len(keys) // 6))
+
+    def sizeHint(self):
+        return self.pixmap.size()
+
+    def arrange(self, size):
+        columns = max(len(row) for row in self.keys)
+        (width, height) = (size.width() // columns, size.height() // len(self.keys))
+        self.rects = []
+        for (y, row) in enumerate(self.keys):
+            left = (size.width() - width * len(row)) // 2
+            for (x, label) in enumerate(row):
+                if label:
+                    self.rects.append((label, QRect(left + x * width, y * height, width, height)))
+        self.pixmap = QPixmap(size)
+        self.pixmap.fill(self.BACKGROUND)
+        painter = QPainter(self.pixmap)
+        painter.setFont(self.keyfont)
+        painter.setPen(self.FOREGROUND)
+        for (label, rect) in self.rects:
+            painter.drawText(rect, Qt.AlignCenter, label)
+        painter.end()
+
+    def resizeEvent(self, event):
+        if event.size() != self.pixmap.size():
+            self.arrange(event.size())
+
+    def key_at(self, pos):
+        for (index, (label, rect)) in enumerate(self.rects):
+            if rect.contains(pos):
+                return index
+        return None
+
+    def mousePressEvent(self, event):
+        index = self.key_at(event.pos())
+        if index is None:
+            return
+        self.pressed_at = time()
+        self.pressed = index
+        self.keyPressed.emit(self.rects[index][0])
+        self.update(self.rects[index][1])
+
+    def mouseReleaseEvent(self, event):
+        if self.pressed is not None:
+            rect = self.rects[self.pressed][1]
+            self.pressed = None
+            self.update(rect)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.drawPixmap(event.rect(), self.pixmap, event.rect())
+        if self.pressed is not None:
+            (label, rect) = self.rects[self.pressed]
+            painter.fillRect(rect, self.HIGHLIGHT)
+            painter.setFont(self.keyfont)
+            painter.setPen(self.FOREGROUND)
+            painter.drawText(rect, Qt.AlignCenter, label)
+        painter.end()
+        now = time()
+        if self.created:
+            log.append("keyboard first frame %.0f ms after creation" % ((now - self.created) * 1000))
+            metrics.observe('keyboard_first_frame', now - self.created)
+            self.created = None
+        if self.pressed_at:
+            log.append("key repainted %.1f ms after the press" % ((now - self.pressed_at) * 1000))
+            metrics.observe('key_repaint', now - self.pressed_at)
+            self.pressed_at = None
+
+
 class MainWindow(QWidget):
     def __init__(self, *args, **kwargs):
         QWidget.__init__(self, *args, **kwargs)
-        with open("photoconfig.yaml", 'r') as stream:
-            self.config = yaml.full_load(stream)
-        realpath = os.path.dirname(os.path.realpath(__file__))
-        for (key, val) in self.config['paths'].items():
-            self.config['paths'][key] = os.path.join(realpath, val)
+        # shared with the photo thread, which gets the live changes in the same dict
+        self.config = photoconf.load()
+        photoconf.watch()
+        timer.mark("config load")
         self.make_gui()
+        timer.mark("GUI built")
         self.foto_thread = FotoThread(config=self.config)
         # connects the pyqtSignal with get_email method
         self.foto_thread.signal.connect(self.get_email)
@@ -63,20 +195,24 @@ class MainWindow(QWidget):
         email = self.line.text().strip()
         self.line.setText("")
         if email:
-            # use email as filename with images paths
-            newaddr = os.path.join(self.config['paths']['addr'], email)
-            with open(newaddr, 'a') as outfile:
-                with open(self.config['paths']['piclist']) as infile:
-                    outfile.write(infile.read())
-            os.remove(self.config['paths']['piclist'])
+            # the photos of the current session are handed to the sender in background
+            self.foto_thread.photo.hand_off(email)
         log.append(email)
 
-    def on_button_press(self):
-        sender = self.sender()
-        if sender.text() == "<":
+    def on_key(self, letter):
+        if letter == "<":
             self.line.backspace()
         else:
-            self.line.insert(sender.text())
+            self.line.insert(letter)
+
+    def on_button_press(self):
+        start = time()
+        self.on_key(self.sender().text())
+        # painted now, so the time is comparable with the repaint of KeyboardWidget
+        self.line.repaint()
+        self.sender().repaint()
+        log.append("key repainted %.1f ms after the press" % ((time() - start) * 1000))
+        metrics.observe('key_repaint', time() - start)
 
     def make_gui(self):
         self.name = None
@@ -111,6 +247,18 @@ class MainWindow(QWidget):
             ['@', 'z', 'x', 'c', 'v', 'b', 'n', 'm', '.', ''],
         ]
 
+        if self.config['gui']['keyboard'] == 'painted':
+            keyboard = KeyboardWidget(keys, self.config['camera']['screen_wh'])
+            keyboard.keyPressed.connect(self.on_key)
+            vbox.addWidget(keyboard, stretchval * len(keys))
+        else:
+            self.make_buttons(vbox, keys, stretchval)
+
+        self.setLayout(vbox)
+
+    def make_buttons(self, vbox, keys, stretchval):
+        # previous keyboard with a widget per key, kept for comparison
+        start = time()
         for row in keys:
             rowlayout = QHBoxLayout()
             rowlayout.setContentsMargins(0, 0, 0, 0)
@@ -124,8 +272,12 @@ class MainWindow(QWidget):
                 klwidget.adjustSize()
                 rowlayout.addWidget(klwidget, stretchval, Qt.AlignBottom)
             vbox.addLayout(rowlayout, stretchval)
+        # first frame of the buttons is counted until the window is shown
+        QTimer.singleShot(0, lambda: self.buttons_shown(start))
 
-        self.setLayout(vbox)
+    def buttons_shown(self, start):
+        log.append("keyboard first frame %.0f ms after creation" % ((time() - start) * 1000))
+        metrics.observe('keyboard_first_frame', time() - start)
 
 
 if __name__ == "__main__":
@@ -133,6 +285,14 @@ if __name__ == "__main__":
         app = QtWidgets.QApplication(sys.argv)
         mainWin = MainWindow()
         mainWin.show()
+        QTimer.singleShot(0, lambda: timer.mark("GUI shown"))
+        # on SIGTERM from the supervisor the photo thread is closed, so the last address is handed over
+        app.aboutToQuit.connect(mainWin.foto_thread.stop)
+        signal.signal(signal.SIGTERM, lambda signum, frame: app.quit())
+        # Python handles the signals only when it runs, so it is woken up from the Qt loop
+        heartbeat = QTimer()
+        heartbeat.timeout.connect(lambda: None)
+        heartbeat.start(500)
         sys.exit(app.exec_())
     except KeyboardInterrupt:
         log.append("keyboard interrupt")
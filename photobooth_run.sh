@@ -1,8 +1,3 @@
 #!/bin/bash
-if ! pidof -x "sendphotos.py" >/dev/null; then
-	 /home/pi/piknik2019/sendphotos.py  > /dev/null 2>&1 &
-fi
-if ! pidof -x "shutdown_reset.py" >/dev/null; then
-	 /home/pi/piknik2019/shutdown_reset.py  > /dev/null 2>&1 &
-fi
-DISPLAY=:0.0 /home/pi/piknik2019/photoboothQt.py > /dev/null 2>&1
+# the supervisor starts the sender, the reset button watcher and the GUI, and restarts them when they exit
+DISPLAY=:0.0 exec /home/pi/piknik2019/supervisor.py > /dev/null 2>&1
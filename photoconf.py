@@ -0,0 +1,318 @@
+'''
+Configuration shared by the photobooth processes.
+
+photoconfig.yaml is read once per process by load(), checked against SCHEMA, completed with the defaults
+and its paths are made absolute. The result is cached, so every module of the process gets the same dict.
+watch() checks the modification time of the file in a background thread and applies the changes of the keys
+in LIVE to that dict in place: values are read when they are used, so the next delay, filter or e-mail
+uses them, and a session in progress goes on. Other changes are logged and need a restart.
+'''
+
+import os
+import threading
+from time import sleep
+
+import yaml
+
+import photologging
+from photologging import Logging
+
+log = Logging()
+
+NUMBER = (int, float)
+REQUIRED = None
+
+# key -> (type, default) or dict of the nested keys; REQUIRED default means the key must be in the file
+SCHEMA = {
+    'autopress': (bool, False),
+    'backend': (str, 'pi'),
+    'pin_camera_btn': (int, REQUIRED),
+    'pin_arcade_led': (int, REQUIRED),
+    'pin_reset_btn': (int, REQUIRED),
+    'debounce': (NUMBER, 0.02),
+    'startup_delay': (NUMBER, 2),
+    'total_pics': (int, 3),
+    'prep_delay': (NUMBER, 3),
+    'timeout_email': (NUMBER, 3),
+    'finish_time': (NUMBER, 2),
+    'camera': {
+        'noprev': (bool, True),
+        'photo_wh': (list, REQUIRED),
+        'screen_wh': (list, REQUIRED),
+        'photo_countdown_time': (int, 3),
+        'photo_playback_time': (NUMBER, 3),
+        'preview_grid': (bool, False),
+        'capture_mode': (str, 'still'),
+        'sensor_mode': (int, 0),
+        'overlay_cache_size': (int, 4),
+        'capture_to_memory': (bool, False),
+        'write_queue': (int, 3),
+        'fsync': (bool, True),
+        'filter_mode': (str, 'live'),
+        'post_filters': (list, []),
+        'filter_threads': (int, 4),
+        'filter_quality': (int, 90),
+        'filters': (list, []),
+    },
+    'gui': {
+        'keyboard': (str, 'painted'),
+        'handoff_timeout': (NUMBER, 2),
+    },
+    'email_copy': {
+        'enabled': (bool, True),
+        'size': (list, [1280, 768]),
+        'quality': (int, 85),
+        'workers': (int, 1),
+    },
+    'paths': {
+        'photopath': (str, 'photo'),
+        'emailcopies': (str, 'photo/email'),
+        'addr': (str, 'addr'),
+        'queue': (str, 'addr/queue.db'),
+        'handoff': (str, 'addr/sender.sock'),
+        'metrics': (str, 'metrics'),
+        'supervisor_lock': (str, 'metrics/supervisor.lock'),
+        'startup1': (str, REQUIRED),
+        'startup2': (str, REQUIRED),
+        'introimg1': (str, REQUIRED),
+        'introimg2': (str, REQUIRED),
+        'processingimg': (str, REQUIRED),
+        'email_image': (str, REQUIRED),
+        'finished_image': (str, REQUIRED),
+        'getready': (str, REQUIRED),
+        'emailmessage': (str, REQUIRED),
+    },
+    'sim': {
+        'time_scale': (NUMBER, 1),
+        'press_delays': (list, [5, 20]),
+        'capture_time': (NUMBER, 0.5),
+        'mode_switch_time': (NUMBER, 0.4),
+    },
+    'logging': {
+        'flush_interval': (NUMBER, 1.0),
+        'max_bytes': (int, 1048576),
+        'backups': (int, 3),
+        'repeat_window': (NUMBER, 60),
+    },
+    'metrics': {
+        'interval': (NUMBER, 10),
+        'http_ports': (dict, {}),
+    },
+    'storage': {
+        'interval': (NUMBER, 60),
+        'max_bytes': (int, 0),
+        'max_age': (NUMBER, 604800),
+        'min_free': (int, 209715200),
+        'orphan_age': (NUMBER, 3600),
+    },
+    'supervisor': {
+        'poll_interval': (NUMBER, 0.5),
+        'restart_delay': (NUMBER, 1),
+        'restart_max_delay': (NUMBER, 60),
+        'stable_time': (NUMBER, 30),
+        'report_interval': (NUMBER, 60),
+        'stop_timeout': (NUMBER, 15),
+    },
+    'config': {
+        'watch_interval': (NUMBER, 2),
+    },
+    'smtp': {
+        'login': (str, REQUIRED),
+        'domain': (str, REQUIRED),
+        'password': (str, REQUIRED),
+        'host': (str, ''),
+        'port': (int, 465),
+        'tls': (str, 'ssl'),
+        'timeout': (NUMBER, 60),
+        'max_messages': (int, 50),
+        'max_age': (NUMBER, 600),
+        'idle_check': (NUMBER, 30),
+        'workers': (int, 1),
+        'rate_per_minute': (NUMBER, 0),
+        'stats_interval': (NUMBER, 60),
+        'retry_delay': (NUMBER, 10),
+        'retry_max_delay': (NUMBER, 900),
+        'max_attempts': (int, 8),
+        'connect_max_delay': (NUMBER, 300),
+        'quiet_window': (NUMBER, 30),
+        'max_message_bytes': (int, 20971520),
+    },
+}
+
+# keys changed live by watch(); a section name stands for all of its keys.
+# The connection settings of smtp apply once the workers reconnect, which Sending.config_changed makes them do;
+# smtp.workers and smtp.stats_interval are read at start only.
+LIVE = {'debounce', 'startup_delay', 'prep_delay', 'timeout_email', 'finish_time',
+        'camera.photo_countdown_time', 'camera.photo_playback_time', 'camera.preview_grid', 'camera.filters',
+        'camera.post_filters', 'email_copy.quality', 'logging', 'storage', 'supervisor',
+        'smtp.login', 'smtp.domain', 'smtp.password', 'smtp.host', 'smtp.port', 'smtp.tls', 'smtp.timeout',
+        'smtp.max_messages', 'smtp.max_age', 'smtp.idle_check', 'smtp.rate_per_minute', 'smtp.retry_delay',
+        'smtp.retry_max_delay', 'smtp.max_attempts', 'smtp.connect_max_delay', 'smtp.quiet_window',
+        'smtp.max_message_bytes'}
+
+PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "photoconfig.yaml")
+
+
+class ConfigError(ValueError):
+    ''' raised when photoconfig.yaml does not match SCHEMA '''
+
+
+def validate(config, schema=SCHEMA, prefix=''):
+    ''' checks the types of the values and fills in the defaults, in place
+
+    Raises
+    ------------
+    ConfigError
+        when a required key is missing or a value has a wrong type
+    '''
+    for (key, spec) in schema.items():
+        name = prefix + key
+        if isinstance(spec, dict):
+            section = config.setdefault(key, {})
+            if not isinstance(section, dict):
+                raise ConfigError("%s: section expected" % name)
+            validate(section, spec, name + '.')
+            continue
+        (kind, default) = spec
+        if key not in config or config[key] is None:
+            if default is REQUIRED:
+                raise ConfigError("%s: missing" % name)
+            config[key] = list(default) if isinstance(default, list) else default
+        value = config[key]
+        if kind == NUMBER and isinstance(value, bool) or not isinstance(value, kind):
+            raise ConfigError("%s: %r is not %s" % (name, value, getattr(kind, '__name__', 'a number')))
+    if schema is SCHEMA and config['smtp']['tls'] not in ('ssl', 'starttls', 'plain'):
+        raise ConfigError("smtp.tls: %r is not ssl, starttls or plain" % config['smtp']['tls'])
+    if schema is SCHEMA and config['camera']['capture_mode'] not in ('still', 'video', 'fixed'):
+        raise ConfigError("camera.capture_mode: %r is not still, video or fixed" % config['camera']['capture_mode'])
+    return config
+
+
+def resolve_paths(config):
+    ''' makes the paths absolute, relative to the directory of the photobooth; absolute paths stay '''
+    realpath = os.path.dirname(os.path.realpath(__file__))
+    for (key, val) in config['paths'].items():
+        config['paths'][key] = os.path.join(realpath, val)
+    return config
+
+
+def read(path=PATH):
+    with open(path, 'r') as stream:
+        config = yaml.full_load(stream)
+    if not isinstance(config, dict):
+        raise ConfigError("%s: mapping expected" % path)
+    return resolve_paths(validate(config))
+
+
+_lock = threading.Lock()
+_cache = {}
+_callbacks = []
+_watcher = None
+
+
+def load(path=PATH):
+    ''' returns the validated config, read only once per process
+
+    Raises
+    ------------
+    ConfigError
+        when the file does not match SCHEMA
+    '''
+    with _lock:
+        if path not in _cache:
+            _cache[path] = (os.path.getmtime(path), read(path))
+        return _cache[path][1]
+
+
+def subscribe(callback):
+    ''' callback(changed) is called from the watcher thread with the list of keys changed live '''
+    _callbacks.append(callback)
+
+
+def is_live(name):
+    return name in LIVE or name.split('.')[0] in LIVE
+
+
+def changes(old, new, prefix=''):
+    ''' returns the list of keys (e.g. "smtp.password") with different values '''
+    found = []
+    for key in set(old) | set(new):
+        name = prefix + key
+        if isinstance(old.get(key), dict) and isinstance(new.get(key), dict) and key in SCHEMA:
+            found.extend(changes(old[key], new[key], name + '.'))
+        elif old.get(key) != new.get(key):
+            found.append(name)
+    return sorted(found)
+
+
+def apply(config, new):
+    ''' copies the live changes from new to config in place
+
+    Returns
+    list
+        keys changed live
+    list
+        keys changed in the file that need a restart
+    '''
+    live = []
+    restart = []
+    for name in changes(config, new):
+        if not is_live(name):
+            restart.append(name)
+            continue
+        (target, source) = (config, new)
+        keys = name.split('.')
+        for key in keys[:-1]:
+            (target, source) = (target[key], source[key])
+        target[keys[-1]] = source[keys[-1]]
+        live.append(name)
+    return live, restart
+
+
+def check(path=PATH):
+    ''' reloads the file if it was modified and applies the live changes '''
+    with _lock:
+        if path not in _cache:
+            return []
+        (mtime, config) = _cache[path]
+        try:
+            current = os.path.getmtime(path)
+        except OSError:
+            return []
+        if current == mtime:
+            return []
+        _cache[path] = (current, config)
+        try:
+            new = read(path)
+        except (OSError, yaml.YAMLError, ConfigError) as e:
+            log.append("config not reloaded: " + " ".join(str(e).splitlines()))
+            return []
+        (live, restart) = apply(config, new)
+    if restart:
+        log.append("config changes applied after restart: " + ", ".join(restart))
+    if not live:
+        return live
+    log.append("config changed live: " + ", ".join(live))
+    if any(name.startswith('logging.') for name in live):
+        photologging.configure(**config['logging'])
+    for callback in list(_callbacks):
+        try:
+            callback(live)
+        except Exception as e:
+            log.append("config change not applied: " + str(e))
+    return live
+
+
+def watch(path=PATH, interval=None):
+    ''' starts the thread reloading the changed file, once per process '''
+    global _watcher
+    if _watcher:
+        return
+    interval = interval or load(path)['config']['watch_interval']
+
+    def loop():
+        while True:
+            sleep(interval)
+            check(path)
+    _watcher = threading.Thread(target=loop, daemon=True)
+    _watcher.start()
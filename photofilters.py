@@ -0,0 +1,131 @@
+'''
+Filters applied to the captured photos after the capture, with NumPy.
+
+The camera filters (image_effect) that map every pixel value on its own are expressed here as lookup tables
+built with NumPy, the ones that reorder the colour channels as channel shuffles. The tables are applied
+by PIL's point(), which is faster than indexing a NumPy copy of the image (see bench_filters.py);
+apply_numpy() does the same on arrays. A photo captured without a filter can then be rendered
+in several filtered variants afterwards, and the variants can be made again from the original.
+Filters needing neighbouring pixels (sketch, emboss, oilpaint, watercolor, cartoon) are not available here.
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+
+def _lut(function):
+    values = np.arange(256, dtype=np.float32)
+    return np.clip(np.round(function(values)), 0, 255).astype(np.uint8)
+
+
+# name -> (lookup table applied to every channel, order of the channels)
+FILTERS = {
+    'none': (None, None),
+    'negative': (_lut(lambda x: 255 - x), None),
+    'solarize': (_lut(lambda x: np.where(x < 128, x, 255 - x)), None),
+    'posterise': (_lut(lambda x: (x // 64) * 85), None),
+    'washedout': (_lut(lambda x: 64 + x * 0.6), None),
+    'colorswap': (None, [2, 1, 0]),
+}
+
+
+def supported(name):
+    return name in FILTERS
+
+
+def apply(img, name):
+    ''' returns the image with the filter applied
+
+    Parameters
+    ------------
+    img : PIL.Image.Image
+        RGB image
+    name : str
+        name of the filter, one of FILTERS
+
+    Returns
+    PIL.Image.Image
+        new filtered image
+    '''
+    lut, order = FILTERS[name]
+    if lut is not None:
+        # point() releases the GIL, so filters of several variants run in parallel threads
+        img = img.point(lut.tolist() * 3)
+    if order is not None:
+        bands = img.split()
+        img = Image.merge('RGB', [bands[x] for x in order])
+    if lut is None and order is None:
+        img = img.copy()
+    return img
+
+
+def apply_numpy(img, name):
+    ''' the same as apply(), made on a NumPy array of the image '''
+    lut, order = FILTERS[name]
+    pixels = np.asarray(img)
+    if lut is not None:
+        pixels = np.take(lut, pixels)
+    if order is not None:
+        pixels = np.ascontiguousarray(pixels[:, :, order])
+    if lut is None and order is None:
+        pixels = pixels.copy()
+    return Image.fromarray(pixels, 'RGB')
+
+
+def apply_pil(img, name):
+    ''' the same filters written with PIL.ImageOps and lambdas, for comparison in bench_filters.py '''
+    if name == 'negative':
+        return ImageOps.invert(img)
+    if name == 'solarize':
+        return ImageOps.solarize(img, 128)
+    if name == 'posterise':
+        return img.point(lambda x: (x // 64) * 85)
+    if name == 'washedout':
+        return img.point(lambda x: min(255, int(round(64 + x * 0.6))))
+    if name == 'colorswap':
+        (r, g, b) = img.split()
+        return Image.merge('RGB', (b, g, r))
+    return img.copy()
+
+
+def variant_path(source, name, directory=None):
+    ''' path of the filtered variant: photo.jpg -> photo_negative.jpg in the directory of the photo '''
+    (stem, ext) = os.path.splitext(os.path.basename(source))
+    return os.path.join(directory or os.path.dirname(source), stem + "_" + name + ext)
+
+
+def render_variants(source, names, quality=90, workers=4, directory=None):
+    ''' decodes the photo once and writes its filtered variants, in parallel threads
+
+    Parameters
+    ------------
+    source : str
+        path of the unfiltered photo
+    names : list
+        names of the filters, the ones not in FILTERS are skipped
+    quality : int, optional
+        JPEG quality of the variants
+    workers : int, optional
+        number of threads, i.e. cores used
+    directory : str, optional
+        directory of the variants, the directory of the photo by default
+
+    Returns
+    list
+        paths of the variants written
+    '''
+    img = Image.open(source).convert('RGB')
+    names = [name for name in names if supported(name)]
+
+    def render(name):
+        target = variant_path(source, name, directory)
+        tmp = target + '.tmp'
+        apply(img, name).save(tmp, 'JPEG', quality=quality)
+        os.replace(tmp, target)
+        return target
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(render, names))
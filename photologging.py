@@ -1,11 +1,145 @@
+import atexit
 import datetime
-import inspect
 import os
+import sys
+import threading
+from queue import Queue, Empty, Full
+from time import time
+
+# settings of the background writer, changed with configure()
+settings = {
+    'flush_interval': 1.0,  # seconds between writes of the buffered lines
+    'max_bytes': 1024 * 1024,  # size of the log file after which it is rotated
+    'backups': 3,  # number of rotated files kept
+    'queue_size': 10000,  # lines buffered before new ones are dropped
+    'repeat_window': 60,  # seconds in which a repeated message is counted instead of written
+    'console': True,  # whether the Logging instances with console=True print to stdout
+}
+
+
+def configure(**kwargs):
+    ''' changes the settings of the log writer, e.g. with the "logging" part of photoconfig.yaml '''
+    settings.update(kwargs)
+
+
+class LogWriter:
+    ''' writes the log lines of all the Logging instances of the process in a background thread
+
+    Lines are buffered in a queue and written in batches every flush_interval seconds,
+    so the callers never wait for the SD card.
+
+    Attributes
+    ------------
+    queue : queue.Queue
+        (logpath, line, console line) tuples waiting to be written
+    dropped : int
+        number of lines dropped because the queue was full
+
+    Methods
+    ------------
+    put(logpath, line, console='')
+        queues the line without blocking
+    flush()
+        writes all the queued lines
+    close()
+        writes the queued lines and stops the thread
+    '''
+
+    def __init__(self):
+        self.queue = Queue(maxsize=settings['queue_size'])
+        self.dropped = 0
+        # held by put, so never while writing
+        self.dropped_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, logpath, line, console=''):
+        try:
+            self.queue.put_nowait((logpath, line, console))
+        except Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def run(self):
+        last_flush = time()
+        while not self.closed:
+            try:
+                first = self.queue.get(timeout=settings['flush_interval'])
+            except Empty:
+                continue
+            # the lines coming until flush_interval after the last write are written with this one
+            self.closing.wait(max(0.0, last_flush + settings['flush_interval'] - time()))
+            self.flush([first])
+            last_flush = time()
+
+    def flush(self, batch=None):
+        batch = batch or []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        with self.dropped_lock:
+            (dropped, self.dropped) = (self.dropped, 0)
+        if dropped:
+            batch.append((batch[0][0] if batch else None, "%d log lines dropped\r\n" % dropped, ''))
+        files = {}
+        for (logpath, line, console) in batch:
+            if console:
+                print(console)
+            if logpath:
+                files.setdefault(logpath, []).append(line)
+        with self.lock:
+            for (logpath, lines) in files.items():
+                self.write(logpath, ''.join(lines))
+
+    def write(self, logpath, text):
+        try:
+            if os.path.exists(logpath) and os.path.getsize(logpath) + len(text) > settings['max_bytes']:
+                self.rotate(logpath)
+            with open(logpath, 'a') as logfile:
+                logfile.write(text)
+        except OSError as e:
+            print("log not written: " + str(e))
+
+    def rotate(self, logpath):
+        for num in range(settings['backups'] - 1, 0, -1):
+            if os.path.exists(logpath + '.' + str(num)):
+                os.replace(logpath + '.' + str(num), logpath + '.' + str(num + 1))
+        if settings['backups']:
+            os.replace(logpath, logpath + '.1')
+        else:
+            os.remove(logpath)
+
+    def close(self):
+        self.closed = True
+        self.closing.set()
+        self.thread.join(settings['flush_interval'] + 1)
+        self.flush()
+
+
+writer = None
+writer_lock = threading.Lock()
+
+
+def get_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = LogWriter()
+    return writer
 
 
 class Logging:
     ''' logs events in the folder of the caller location in the file <caller-name>.log
 
+    Lines are written by a shared background LogWriter. A message repeated within
+    repeat_window seconds is counted instead of written again.
+
     Attributes
     ----------
     name : str
@@ -26,18 +160,32 @@ class Logging:
     def __init__(self, name='', console=True):
         self.name = name
         self.console = console
-        stack = inspect.stack()
-        stacknum = 1 if len(stack) > 1 else 0
-        previous = stack[stacknum].filename
+        # only the caller's frame is needed, inspect.stack() would read the source of every frame
+        previous = sys._getframe(1).f_code.co_filename
         (callerdir, callername) = os.path.split(previous)
         if not self.name:
             self.name = os.path.splitext(callername)[0]
         logname = self.name + '.log'
         dirname = os.path.realpath(callerdir)
         self.logpath = os.path.join(dirname, logname)
+        self.last = None
+        self.last_time = 0.0
+        self.repeated = 0
+        self.lock = threading.Lock()
 
     def append(self, text=''):
-        if self.console:
-            print(self.name + ": " + text)
-        with open(self.logpath, 'a') as logfile:
-            logfile.write(str(datetime.datetime.now()).split('.')[0] + " " + text + '\r\n')
+        now = time()
+        with self.lock:
+            if text == self.last and now - self.last_time < settings['repeat_window']:
+                self.repeated += 1
+                return
+            if self.repeated:
+                self.emit("last message repeated %d times" % self.repeated)
+            self.repeated = 0
+            self.last = text
+            self.last_time = now
+        self.emit(text)
+
+    def emit(self, text):
+        console = self.name + ": " + text if self.console and settings['console'] else ''
+        get_writer().put(self.logpath, str(datetime.datetime.now()).split('.')[0] + " " + text + '\r\n', console)
@@ -0,0 +1,231 @@
+'''
+Timing metrics and counters of the photobooth processes.
+
+Every process has one registry (metrics). Stages are timed with timed(), either as a decorator or as
+a context manager, and kept in rolling windows from which p50, p95 and max are computed.
+The registry is exported in the Prometheus text format to a file, and optionally served on localhost.
+'''
+
+import os
+import threading
+from collections import deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import time, sleep
+
+from photologging import Logging
+
+log = Logging()
+
+
+class Histogram:
+    ''' rolling window of observations with quantiles
+
+    Attributes
+    ------------
+    window : collections.deque
+        last observations
+    count : int
+        number of all observations
+    total : float
+        sum of all observations
+
+    Methods
+    ------------
+    observe(value)
+        adds the observation
+    summary()
+        returns dict with p50, p95 and max of the window, and count and sum of all observations
+    '''
+
+    def __init__(self, size=500):
+        self.window = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.window.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        values = sorted(self.window)
+        if not values:
+            return {'p50': 0.0, 'p95': 0.0, 'max': 0.0, 'count': self.count, 'sum': self.total}
+        return {'p50': values[(len(values) - 1) // 2],
+                'p95': values[int(round(0.95 * (len(values) - 1)))],
+                'max': values[-1],
+                'count': self.count,
+                'sum': self.total}
+
+
+class Registry:
+    ''' counters, gauges and stage histograms of a process
+
+    Attributes
+    ------------
+    prefix : str
+        prefix of the exported metric names
+    counters : dict
+        name -> value
+    gauges : dict
+        name -> value or function returning the value
+    histograms : dict
+        stage name -> Histogram of durations in seconds
+
+    Methods
+    ------------
+    inc(name, value=1)
+        increases the counter
+    set(name, value)
+        sets the gauge to a value or a function called at export
+    observe(stage, seconds)
+        records the duration of the stage
+    render()
+        returns all the metrics in the Prometheus text format
+    '''
+
+    def __init__(self, prefix='photobooth'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            summaries = sorted((stage, histogram.summary()) for (stage, histogram) in self.histograms.items())
+        lines = []
+        for (name, value) in counters:
+            lines.append("# TYPE %s_%s_total counter" % (self.prefix, name))
+            lines.append("%s_%s_total %s" % (self.prefix, name, value))
+        for (name, value) in gauges:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    log.append("gauge %s not read: %s" % (name, e))
+                    continue
+            lines.append("# TYPE %s_%s gauge" % (self.prefix, name))
+            lines.append("%s_%s %s" % (self.prefix, name, value))
+        if summaries:
+            metric = self.prefix + "_stage_seconds"
+            lines.append("# TYPE %s summary" % metric)
+            for (stage, summary) in summaries:
+                lines.append('%s{stage="%s",quantile="0.5"} %.6f' % (metric, stage, summary['p50']))
+                lines.append('%s{stage="%s",quantile="0.95"} %.6f' % (metric, stage, summary['p95']))
+                lines.append('%s_sum{stage="%s"} %.6f' % (metric, stage, summary['sum']))
+                lines.append('%s_count{stage="%s"} %d' % (metric, stage, summary['count']))
+            lines.append("# TYPE %s_max gauge" % metric)
+            for (stage, summary) in summaries:
+                lines.append('%s_max{stage="%s"} %.6f' % (metric, stage, summary['max']))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+
+class StageTimer:
+    ''' times a stage into the process registry, as a decorator or as a context manager
+
+    Parameters
+    ------------
+    stage : str
+        name of the stage
+    '''
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics.observe(self.stage, time() - self.start)
+
+    def __call__(self, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.observe(self.stage, time() - start)
+        return wrapper
+
+
+def timed(stage):
+    ''' returns StageTimer for the stage, e.g. @timed('capture') or with timed('capture'): '''
+    return StageTimer(stage)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_file(path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as promfile:
+        promfile.write(metrics.render())
+    os.replace(tmp, path)
+
+
+def export_loop(path, interval):
+    while True:
+        sleep(interval)
+        try:
+            write_file(path)
+        except OSError as e:
+            log.append("metrics not written: " + str(e))
+
+
+def start_export(config, name, directory):
+    ''' starts writing the metrics of the process to <directory>/<name>.prom and serving them over HTTP
+
+    Parameters
+    ------------
+    config : dict
+        "metrics" part of the config: interval and http_ports (process name -> port, 0 disables)
+    name : str
+        name of the process, used as the file name and the metric prefix
+    directory : str
+        directory for the metrics files
+    '''
+    metrics.prefix = name
+    if config.get('interval', 10):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        threading.Thread(target=export_loop, args=(os.path.join(directory, name + '.prom'), config.get('interval', 10)),
+                         daemon=True).start()
+    port = config.get('http_ports', {}).get(name, 0)
+    if port:
+        server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log.append("metrics served on http://127.0.0.1:%d/metrics" % port)
@@ -1,13 +1,45 @@
-from time import sleep
+import glob
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import time
 
-import picamera
-import RPi.GPIO as gpio
 from PIL import Image
 
+from boothclock import clock, sleep
 from photologging import Logging
+from photometrics import metrics, timed
 
 log = Logging()
 
+# modules driving the hardware, selected with use_backend()
+gpio = None
+picamera = None
+
+
+def use_backend(name='pi', config=None):
+    ''' selects the modules driving GPIO and camera, imported only when selected
+
+    Parameters
+    ------------
+    name : str
+        "pi" for RPi.GPIO and picamera, "sim" for the simulated hardware from simhw
+    config : dict, optional
+        "sim" part of the config, used by the simulated hardware
+    '''
+    global gpio, picamera
+    if name == 'sim':
+        import simhw
+        gpio = simhw.SimGPIO(config or {})
+        simhw.configure(config or {})
+        picamera = simhw
+    else:
+        import RPi.GPIO as gpio
+        import picamera
+    log.append("hardware backend " + name)
+
 
 class PushButton:
     ''' A class handling the response from push button connected to GPIO in RaspberryPi
@@ -18,6 +50,12 @@ class PushButton:
         number of GPIO pin to which button is connected in BCM numbering
     autopress : bool
         whether the button should be pressed automatically (for testing)
+    debounce : float
+        time in seconds after the falling edge when the button is checked to be still pressed
+    pressed : threading.Event
+        set when the button has been pressed (or released with release())
+    pressed_at : float
+        time of the falling edge of the last press
     waspressed : bool
         flag to use outside class indicating whether button has been pressed
 
@@ -26,37 +64,59 @@ class PushButton:
     detect_press()
         starts event from RPi.GPIO library that monitors for press and assigns set_press as event callback
     set_pressed()
-        sets waspressed flag, removes event detection RPi.GPIO library for the button
+        sets pressed event, removes event detection RPi.GPIO library for the button
+    wait(timeout=None)
+        waits for the press at most timeout seconds; returns whether the button was pressed
+    release()
+        sets pressed event without a press, e.g. to abort waiting
     close()
         triggers set_pressed() and releases the GPIO slot assignment
     '''
 
-    def __init__(self, buttonbcm=17, autopress=False):
+    def __init__(self, buttonbcm=17, autopress=False, debounce=0.02):
+        if gpio is None:
+            use_backend()
         self.buttonbcm = buttonbcm
         self.autopress = autopress
-        self.waspressed = False
+        self.debounce = debounce
+        self.pressed = threading.Event()
+        self.pressed_at = 0.0
         gpio.setmode(gpio.BCM)
         gpio.setup(self.buttonbcm, gpio.IN, pull_up_down=gpio.PUD_UP)
 
+    @property
+    def waspressed(self):
+        return self.pressed.is_set()
+
     def detect_press(self):
         if self.autopress:
-            self.waspressed = True
+            self.pressed_at = time()
+            self.pressed.set()
         else:
-            self.waspressed = False
+            self.pressed.clear()
             gpio.add_event_detect(self.buttonbcm, gpio.FALLING,
                                   callback=lambda x: self.set_pressed(), bouncetime=300)
             log.append("waits for press")
 
     def set_pressed(self):
-        sleep(0.1)
+        edge = time()
+        sleep(self.debounce)
         if gpio.input(self.buttonbcm):
             log.append("false trigger")
             return
-        self.waspressed = True
+        self.pressed_at = edge
+        self.pressed.set()
         log.append("button pressed")
         gpio.remove_event_detect(self.buttonbcm)
 
+    def wait(self, timeout=None):
+        return clock.wait(self.pressed, timeout)
+
+    def release(self):
+        self.pressed.set()
+
     def close(self):
+        self.release()
         self.set_pressed()
         gpio.cleanup(self.buttonbcm)
 
@@ -64,6 +124,9 @@ class PushButton:
 class LedButton:
     ''' A class handling the behaviour of LED (possibly inside the button) connected to GPIO in RaspberryPi
 
+    Patterns are played in a background thread, so the caller does not wait for them.
+    Any other call changing the LED cancels the pattern.
+
     Attributes
     ------------
     buttonbcm : int
@@ -77,12 +140,22 @@ class LedButton:
         turns LED on; if time (in seconds) > 0, turns LED off after that time
     turn_off(time=0.0)
         turns LED off; if time (in seconds) > 0, turns LED on after that time
+    play(steps, repeat=False, callback=None)
+        plays the list of (state, seconds) steps in background; callback(state) is called on each step
+    blink(on_time=1.0, off_time=1.0, callback=None)
+        blinks in background until cancelled
+    stop()
+        cancels the pattern being played
     close()
         turn LED off and releases the GPIO slot assignment
     '''
 
     def __init__(self, buttonbcm=4):
+        if gpio is None:
+            use_backend()
         self.buttonbcm = buttonbcm
+        self.thread = None
+        self.stopped = threading.Event()
         gpio.setmode(gpio.BCM)
         gpio.setup(self.buttonbcm, gpio.OUT, initial=gpio.LOW)
 
@@ -91,22 +164,244 @@ class LedButton:
         sleep(halfperiod)
 
     def turn_on(self, time=0.0):
+        self.stop()
         gpio.output(self.buttonbcm, 1)
         if time:
             sleep(time)
             self.turn_off()
 
     def turn_off(self, time=0.0):
+        self.stop()
         gpio.output(self.buttonbcm, 0)
         if time:
             sleep(time)
             self.turn_on()
 
+    def play(self, steps, repeat=False, callback=None):
+        self.stop()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run_pattern, args=(steps, repeat, callback, self.stopped),
+                                       daemon=True)
+        self.thread.start()
+
+    def blink(self, on_time=1.0, off_time=1.0, callback=None):
+        self.play([(1, on_time), (0, off_time)], repeat=True, callback=callback)
+
+    def run_pattern(self, steps, repeat, callback, stopped):
+        while True:
+            for (state, duration) in steps:
+                gpio.output(self.buttonbcm, state)
+                if callback:
+                    callback(state)
+                # the wait is the cancellable timer of the pattern
+                if clock.wait(stopped, duration):
+                    return
+            if not repeat:
+                return
+
+    def stop(self):
+        if self.thread:
+            self.stopped.set()
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            self.thread = None
+
     def close(self):
         self.turn_off()
         gpio.cleanup(self.buttonbcm)
 
 
+class OverlayCache:
+    ''' A cache of decoded images padded to the size required by PiCamera overlays
+
+    Images are kept as ready buffers, so showing an overlay does not need to read the file,
+    decode it and copy it into a padded image again. Entries are keyed on path and modification time.
+
+    Attributes
+    ------------
+    maxsize : int
+        maximum number of ad-hoc (not preloaded) images kept in the cache
+    preloaded : dict
+        path -> (mtime, buffer, size) for images loaded at startup, never evicted
+    adhoc : collections.OrderedDict
+        path -> (mtime, buffer, size) for images loaded on demand (e.g. captured photos), least recently used first
+    previews : dict
+        key -> (buffer, size) for screen-sized previews of the current session, used before the files
+    hits : int
+        number of lookups served from the cache
+    misses : int
+        number of lookups that needed decoding of the image
+    decode_time : float
+        total time in seconds spent on decoding and padding images
+
+    Methods
+    ------------
+    preload(paths)
+        decodes and pads all the png images from the list of paths; paths without extension are used as prefixes
+    get(im)
+        returns (buffer, size) tuple for the image, decoding it if needed
+    add_preview(key, img)
+        pads the PIL image and keeps it as the preview for the key (e.g. path of the full-size photo)
+    clear_previews()
+        drops the previews of the previous session
+    stats()
+        returns a string with hit/miss counts and decode time
+    '''
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.preloaded = {}
+        self.adhoc = OrderedDict()
+        self.previews = {}
+        self.hits = 0
+        self.misses = 0
+        self.decode_time = 0.0
+
+    def preload(self, paths):
+        for path in paths:
+            if path in self.preloaded:
+                continue
+            if not os.path.splitext(path)[1]:
+                # prefix of numbered images, e.g. get_ready_
+                for numbered in sorted(glob.glob(path + "*.png")):
+                    self._load(numbered, self.preloaded)
+            elif path.lower().endswith(".png") and os.path.isfile(path):
+                self._load(path, self.preloaded)
+        log.append("overlay cache: preloaded %d images in %.3f s" % (len(self.preloaded), self.decode_time))
+
+    def get(self, im):
+        entry = self.previews.get(im)
+        if entry:
+            self.hits += 1
+            return entry
+        mtime = os.path.getmtime(im)
+        entry = self.preloaded.get(im)
+        if entry and entry[0] == mtime:
+            self.hits += 1
+            return entry[1], entry[2]
+        if im in self.preloaded:
+            self.misses += 1
+            return self._load(im, self.preloaded)
+        entry = self.adhoc.get(im)
+        if entry and entry[0] == mtime:
+            self.hits += 1
+            self.adhoc.move_to_end(im)
+            return entry[1], entry[2]
+        self.misses += 1
+        buffer, size = self._load(im, self.adhoc)
+        while len(self.adhoc) > self.maxsize:
+            self.adhoc.popitem(last=False)
+        return buffer, size
+
+    def add_preview(self, key, img):
+        self.previews[key] = (self._pad(img), img.size)
+
+    def clear_previews(self):
+        self.previews = {}
+
+    def stats(self):
+        return "overlay cache: %d hits, %d misses, %.3f s decoding" % (self.hits, self.misses, self.decode_time)
+
+    def _load(self, im, store):
+        start = time()
+        mtime = os.path.getmtime(im)
+        img = Image.open(im)
+        buffer = self._pad(img)
+        store[im] = (mtime, buffer, img.size)
+        self.decode_time += time() - start
+        return buffer, img.size
+
+    @staticmethod
+    def _pad(img):
+        # Create an image padded to the required size with
+        # mode 'RGB'
+        pad = Image.new('RGB', (
+            ((img.size[0] + 31) // 32) * 32,
+            ((img.size[1] + 15) // 16) * 16,
+        ))
+        # Paste the original image into the padded one
+        pad.paste(img, (0, 0))
+        try:
+            return pad.tobytes()
+        except AttributeError:
+            return pad.tostring()
+
+
+class OverlayPool:
+    ''' A pool of PiCamera overlay renderers reused between the screens
+
+    Renderers are kept per layer and size. Hiding an overlay makes it transparent and returns its renderer
+    to the pool, showing an overlay updates the buffer of a free renderer in place, so a screen change
+    does not allocate a new renderer.
+
+    Attributes
+    ------------
+    camera : picamera.PiCamera
+        camera that owns the renderers
+    free : dict
+        (layer, size) -> list of hidden renderers ready for reuse
+    busy : dict
+        renderer -> (layer, size) for renderers currently shown
+    created : int
+        number of renderers allocated
+    reused : int
+        number of times a renderer was reused
+
+    Methods
+    ------------
+    show(buffer, size, layer=3)
+        shows the buffer on a free renderer for the layer and size, allocating one if needed
+    hide(renderer)
+        makes the renderer transparent and returns it to the pool
+    set_visible(renderer, visible=True)
+        toggles renderer visibility without returning it to the pool
+    close()
+        removes all the renderers from the camera
+    '''
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.free = {}
+        self.busy = {}
+        self.created = 0
+        self.reused = 0
+
+    def show(self, buffer, size, layer=3):
+        key = (layer, tuple(size))
+        free = self.free.setdefault(key, [])
+        if free:
+            renderer = free.pop()
+            # the renderer is transparent while its buffer is swapped
+            renderer.update(buffer)
+            self.reused += 1
+        else:
+            renderer = self.camera.add_overlay(buffer, size=size, layer=layer)
+            self.created += 1
+        renderer.alpha = 255
+        self.busy[renderer] = key
+        return renderer
+
+    def hide(self, renderer):
+        key = self.busy.pop(renderer, None)
+        if key is None:
+            return
+        renderer.alpha = 0
+        self.free[key].append(renderer)
+
+    def set_visible(self, renderer, visible=True):
+        if renderer in self.busy:
+            renderer.alpha = 255 if visible else 0
+
+    def close(self):
+        for renderer in list(self.busy):
+            self.hide(renderer)
+        for renderers in self.free.values():
+            for renderer in renderers:
+                self.camera.remove_overlay(renderer)
+        self.free = {}
+        log.append("overlay pool: %d renderers created, %d reused" % (self.created, self.reused))
+
+
 class Camera:
     ''' A class handling the PiCamera Display for the Photobooth
 
@@ -116,14 +411,26 @@ class Camera:
         config file for camera and function paramters
     currfilter : int
         number of camera filter (from config) recently used
-    filterlen : int
-        length of list with camera filters
     camera.rotation : int
         rotation of camera preview
     camera.annotate_text_size : int
         text size for camera annotations
     camera.resolution : (int,int)
         resolution of the camera preview
+    capture_mode : str
+        "still" - capture through the still port, switching the sensor mode and settling exposure for every photo,
+        "video" - capture through the video port feeding the preview, "fixed" - still port capture in the sensor mode
+        of the preview, with exposure and white balance locked for the session
+    cache : OverlayCache
+        cache of padded overlay images
+    overlays : OverlayPool
+        pool of overlay renderers reused between screens
+    previewer : concurrent.futures.ThreadPoolExecutor
+        thread making the screen-sized previews of the captured photos
+    pending : list
+        futures of the previews not yet shown
+    images : dict
+        path -> PIL image of the previews of the current session, used for the grid
 
     Methods
     ------------
@@ -131,23 +438,38 @@ class Camera:
         sets the camera preview (layer 2) transparent
     set_opaque()
         sets the camera preview (layer 2) opaque
+    preload_overlays(first, paths)
+        decodes and pads the first overlay images at once and the others in advance, in a background thread
     overlay_image(im, duration=0, layer=3)
         adds overlay from image above the camera preview
     remove_overlay(overlay_id=None)
-        removes overlay from camera display
+        hides overlay and returns its renderer to the pool
+    set_overlay_visible(overlay_id, visible=True)
+        shows or hides overlay without releasing it
+    lock_exposure()
+        in the "fixed" capture mode, locks exposure and white balance at their current values
+    unlock_exposure()
+        returns exposure and white balance to automatic
     take_photo(target='', iffilter=False)
         displays camera preview with preparation countdown, takes a single photo and writes it to file
+    make_preview(path)
+        makes the screen-sized preview of the photo in background
+    make_grid(paths)
+        makes the preview of all the photos on one screen in background, after their previews
+    clear_previews()
+        drops the previews of the previous session
     img_preview(imglist=None)
-        displays preview of the captured photos
+        displays preview of the captured photos, one by one or as a grid
     close()
         stops camera preview
     '''
 
     def __init__(self, config):
         log.append("camera start")
+        if picamera is None:
+            use_backend()
         self.config = config
         self.currfilter = -1
-        self.filterlen = len(self.config['filters'])
         picamera.PiCamera.CAPTURE_TIMEOUT = 60  # seconds
         try:
             self.camera = picamera.PiCamera()
@@ -157,8 +479,22 @@ class Camera:
             raise SystemExit
         self.camera.rotation = 0
         self.camera.annotate_text_size = 80
+        self.capture_mode = self.config.get('capture_mode', 'still')
+        if self.capture_mode == 'fixed' and self.config.get('sensor_mode', 0):
+            # preview and photos come from the same sensor mode, the firmware does not switch it to capture
+            self.camera.sensor_mode = self.config['sensor_mode']
         self.camera.resolution = self.config['photo_wh']
         self.camera.start_preview(resolution=self.config['screen_wh'])
+        self.cache = OverlayCache(self.config.get('overlay_cache_size', 4))
+        self.overlays = OverlayPool(self.camera)
+        self.previewer = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.images = {}
+
+    def preload_overlays(self, first, paths):
+        # the first images are shown right away, decoding them in the background too would do it twice
+        self.cache.preload(list(first))
+        threading.Thread(target=self.cache.preload, args=(list(paths),), daemon=True).start()
 
     def set_transparent(self):
         self.camera.preview.alpha = 0
@@ -166,6 +502,7 @@ class Camera:
     def set_opaque(self):
         self.camera.preview.alpha = 255
 
+    @timed('overlay_image')
     def overlay_image(self, im, duration=0, layer=3):
         '''adds overlay from image above the camera preview
 
@@ -179,45 +516,57 @@ class Camera:
             number of layer for overlay placement
         Returns
         picamera.PiOverlayRenderer
-            a picamera.PiOverlayRenderer instance for created overlay
+            a picamera.PiOverlayRenderer instance from the overlay pool
         '''
 
         if not im:
             return None
-        img = Image.open(im)
-        # Create an image padded to the required size with
-        # mode 'RGB'
-        pad = Image.new('RGB', (
-            ((img.size[0] + 31) // 32) * 32,
-            ((img.size[1] + 15) // 16) * 16,
-        ))
-        # Paste the original image into the padded one
-        pad.paste(img, (0, 0))
-        # Add the overlay with the padded image as the source,
+        # padded buffer from the cache as the source,
         # but the original image's dimensions
-        try:
-            o_id = self.camera.add_overlay(pad.tobytes(), size=img.size)
-        except AttributeError:
-            o_id = self.camera.add_overlay(pad.tostring(), size=img.size)
-        o_id.layer = layer
+        buffer, size = self.cache.get(im)
+        o_id = self.overlays.show(buffer, size, layer)
         if duration > 0:
             sleep(duration)
-            self.camera.remove_overlay(o_id)
+            self.overlays.hide(o_id)
             return None
         else:
             return o_id
 
     def remove_overlay(self, overlay_id=None):
         if overlay_id:
-            self.camera.remove_overlay(overlay_id)
+            self.overlays.hide(overlay_id)
 
+    def set_overlay_visible(self, overlay_id, visible=True):
+        if overlay_id:
+            self.overlays.set_visible(overlay_id, visible)
+
+    def lock_exposure(self):
+        if self.capture_mode != 'fixed':
+            return
+        # the values settled on the preview are kept, so the capture does not wait for them again
+        self.camera.shutter_speed = self.camera.exposure_speed
+        self.camera.exposure_mode = 'off'
+        gains = self.camera.awb_gains
+        self.camera.awb_mode = 'off'
+        self.camera.awb_gains = gains
+        log.append("exposure locked at %d us, white balance gains %.2f, %.2f"
+                   % (self.camera.shutter_speed, float(gains[0]), float(gains[1])))
+
+    def unlock_exposure(self):
+        if self.capture_mode != 'fixed':
+            return
+        self.camera.shutter_speed = 0
+        self.camera.exposure_mode = 'auto'
+        self.camera.awb_mode = 'auto'
+
+    @timed('take_photo')
     def take_photo(self, target='', iffilter=False):
         '''displays camera preview with preparation countdown, takes a single photo and writes it to file
 
         Parameters
         ------------
-        target : str
-            address to store the photo
+        target : str or file-like object
+            address to store the photo, or stream the JPEG is written to
         iffilter : bool, optional
             whether to apply one of the camera filters
         '''
@@ -225,22 +574,74 @@ class Camera:
         if not target:
             return
         log.append("filter " + str(iffilter))
-        if iffilter:
-            self.currfilter += 1
-            if self.currfilter >= self.filterlen:
-                self.currfilter -= self.filterlen
+        if iffilter and self.config['filters']:
+            # the list of filters can change while running
+            self.currfilter = (self.currfilter + 1) % len(self.config['filters'])
             log.append("filter " + self.config['filters'][self.currfilter])
             self.camera.image_effect = self.config['filters'][self.currfilter]
         for i in range(self.config['photo_countdown_time'], 0, -1):
             self.camera.annotate_text = "             ..." + str(i)
             sleep(1)
         self.camera.annotate_text = ""
-        self.camera.capture(target)
+        # lag between the end of the countdown and the photo, compared between the capture modes
+        countdown_end = clock.now()
+        with timed('capture'):
+            self.camera.capture(target, format='jpeg', use_video_port=self.capture_mode == 'video')
+        lag = clock.now() - countdown_end
+        metrics.observe('shutter_lag_' + self.capture_mode, lag)
+        log.append("shutter lag %.0f ms (%s)" % (lag * 1000, self.capture_mode))
         self.camera.image_effect = 'none'
 
+    def make_preview(self, path):
+        self.pending.append(self.previewer.submit(self._preview, path))
+
+    def make_grid(self, paths):
+        self.pending.append(self.previewer.submit(self._grid, list(paths)))
+
+    def clear_previews(self):
+        wait(self.pending)
+        self.pending = []
+        self.images = {}
+        self.cache.clear_previews()
+
+    def _preview(self, path):
+        start = time()
+        screen = tuple(self.config['screen_wh'])
+        img = Image.open(path)
+        # the JPEG decoder scales by 1/2, 1/4 or 1/8 while decoding, to the smallest size still above the screen
+        img.draft('RGB', screen)
+        img = img.convert('RGB')
+        img.thumbnail(screen, Image.BILINEAR)
+        self.cache.add_preview(path, img)
+        self.images[path] = img
+        log.append("preview of %s in %.0f ms" % (os.path.basename(path), (time() - start) * 1000))
+        return img
+
+    def _grid(self, paths):
+        screen = tuple(self.config['screen_wh'])
+        cols = int(math.ceil(math.sqrt(len(paths))))
+        rows = int(math.ceil(len(paths) / float(cols)))
+        cell = (screen[0] // cols, screen[1] // rows)
+        grid = Image.new('RGB', screen)
+        for (i, path) in enumerate(paths):
+            img = self.images.get(path) or self._preview(path)
+            img = img.copy()
+            img.thumbnail(cell, Image.BILINEAR)
+            grid.paste(img, ((i % cols) * cell[0] + (cell[0] - img.size[0]) // 2,
+                             (i // cols) * cell[1] + (cell[1] - img.size[1]) // 2))
+        self.cache.add_preview(self.grid_key(paths), grid)
+
+    @staticmethod
+    def grid_key(paths):
+        return "grid:" + ",".join(paths)
+
+    @timed('img_preview')
     def img_preview(self, imglist=None, ov=False):
         '''displays preview of the captured photos
 
+        Previews made in background by make_preview and make_grid are shown at once,
+        photos without them are decoded here.
+
         Parameters
         ------------
         imglist : list
@@ -248,6 +649,14 @@ class Camera:
         '''
 
         if not self.config['noprev']:
+            wait(self.pending)
+            if self.config.get('preview_grid', False):
+                if self.grid_key(imglist) not in self.cache.previews:
+                    self._grid(imglist)
+                ov = self.overlay_image(self.grid_key(imglist), 0, 3)
+                sleep(self.config['photo_playback_time'])
+                self.remove_overlay(ov)
+                return
             ov_list = []
             i = 0
             for photo in imglist:
@@ -259,4 +668,6 @@ class Camera:
                 self.remove_overlay(ov)
 
     def close(self):
+        self.previewer.shutdown(wait=False)
+        self.overlays.close()
         self.camera.stop_preview()
@@ -0,0 +1,123 @@
+'''
+Background writing of the captured photos.
+
+The camera captures into memory and the JPEG is written to the SD card by a writer thread, so a slow
+card write never delays the next get-ready screen. A photo is first written to a temporary file and
+renamed, so a file with the photo name is always complete; the callback announcing the photo
+(e.g. to the send queue) runs only after that.
+'''
+
+import os
+import queue
+import threading
+from time import time
+
+from photologging import Logging
+from photometrics import metrics
+
+log = Logging()
+
+
+class PhotoWriter:
+    ''' writes captured photos to files in a background thread
+
+    Attributes
+    ------------
+    jobs : queue.Queue
+        bounded queue of (path, data, callback); put() blocks when the writer is that far behind
+    fsync : bool
+        whether the file and the directory are synced to the card before the callback
+    removed : float
+        seconds of writing taken off the capture path since the last reset_stats()
+
+    Methods
+    ------------
+    start()
+        starts the writer thread
+    put(path, data, callback=None)
+        queues the photo bytes to be written to path, callback(path) is called once the file is durable
+    flush()
+        waits until all the queued photos are written
+    reset_stats()
+        returns and zeroes the number of photos written and the writing time taken off the capture path
+    close()
+        writes the queued photos and stops the thread
+    '''
+
+    def __init__(self, queue_size=3, fsync=True):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.fsync = fsync
+        self.thread = None
+        self.lock = threading.Lock()
+        self.written = 0
+        self.removed = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, path, data, callback=None):
+        start = time()
+        self.jobs.put((path, data, callback))
+        waited = time() - start
+        if waited > 0.01:
+            log.append("writer queue full, waited %.0f ms" % (waited * 1000))
+
+    def write(self, path, data):
+        tmp = path + '.part'
+        with open(tmp, 'wb') as photofile:
+            photofile.write(data)
+            if self.fsync:
+                photofile.flush()
+                os.fsync(photofile.fileno())
+        os.replace(tmp, path)
+        if self.fsync:
+            # the rename is durable only when the directory is synced as well
+            dirfd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                (path, data, callback) = job
+                start = time()
+                try:
+                    self.write(path, data)
+                except OSError as e:
+                    log.append("photo not written: " + path + " " + str(e))
+                    continue
+                elapsed = time() - start
+                metrics.observe('photo_write', elapsed)
+                with self.lock:
+                    self.written += 1
+                    self.removed += elapsed
+                log.append("%s written in %.0f ms off the capture path" % (os.path.basename(path), elapsed * 1000))
+                if callback:
+                    try:
+                        callback(path)
+                    except Exception as e:
+                        log.append("after write of " + path + ": " + str(e))
+            finally:
+                self.jobs.task_done()
+
+    def flush(self):
+        self.jobs.join()
+
+    def reset_stats(self):
+        with self.lock:
+            (written, removed) = (self.written, self.removed)
+            self.written = 0
+            self.removed = 0.0
+        return written, removed
+
+    def close(self):
+        if self.thread:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+Storage retention of the photobooth: keeps photo/ and its e-mail copies within the quotas of photoconfig.yaml.
+
+Runs as a background thread of the sender (or as a script), so deleting files never blocks the capture.
+Every pass:
+ - deletes the photos of abandoned sessions (no e-mail given)
+ - deletes orphaned files, i.e. not needed by an open session or an unsent recipient, once they are
+   older than orphan_age (sent photos, failed recipients, leftovers of crashes)
+ - expires recipients still unsent after max_age and removes old finished sessions from the queue
+ - while the files take more than max_bytes or the card has less than min_free bytes free, deletes
+   originals that have an e-mail copy, then expires the oldest unsent sessions
+'''
+
+import os
+import threading
+from time import sleep, time
+
+import photoconf
+from photologging import Logging
+from photometrics import metrics
+from sendqueue import SendQueue
+
+log = Logging()
+
+
+class Reaper:
+    ''' background retention of the photo files
+
+    Attributes
+    ------------
+    config : dict
+        "storage" part of the config: interval, max_bytes, max_age, min_free and orphan_age
+    queue : SendQueue
+        queue telling which photos are still needed
+    dirs : list
+        directories with the photo files: photos first, e-mail copies second
+    index : dict
+        path -> (size, mtime) of the files found in the last scan
+    reaped : int
+        number of files deleted
+    freed : int
+        number of bytes freed
+
+    Methods
+    ------------
+    start()
+        starts the background thread
+    run_once()
+        runs a single pass and returns the number of files deleted
+    scan()
+        rebuilds the index of the files and returns their total size
+    free_space()
+        returns the number of bytes free on the card
+    '''
+
+    def __init__(self, config, queue, photodir, copydir):
+        self.config = config
+        self.queue = queue
+        self.dirs = [photodir, copydir]
+        self.index = {}
+        self.reaped = 0
+        self.freed = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        metrics.set('storage_bytes', lambda: sum(x[0] for x in list(self.index.values())))
+        metrics.set('storage_free_bytes', self.free_space)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                log.append("reaper pass failed: " + " ".join(str(e).splitlines()))
+            sleep(self.config.get('interval', 60))
+
+    def scan(self):
+        index = {}
+        for directory in self.dirs:
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    index[entry.path] = (stat.st_size, stat.st_mtime)
+        self.index = index
+        return sum(x[0] for x in index.values())
+
+    def free_space(self):
+        stat = os.statvfs(self.dirs[0])
+        return stat.f_bavail * stat.f_frsize
+
+    def delete(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            log.append("not deleted: " + path + " " + str(e))
+            return False
+        size = self.index.pop(path, (0, 0))[0]
+        self.reaped += 1
+        self.freed += size
+        metrics.inc('files_reaped')
+        return True
+
+    def delete_photos(self, photos):
+        deleted = 0
+        for photo in photos:
+            for directory in self.dirs:
+                path = os.path.join(directory, photo)
+                if os.path.exists(path) and self.delete(path):
+                    deleted += 1
+        return deleted
+
+    def run_once(self):
+        with self.lock:
+            now = time()
+            deleted = 0
+            for (session_id, photos) in self.queue.abandoned():
+                deleted += self.delete_photos(photos)
+                self.queue.purge(session_id)
+            max_age = self.config.get('max_age', 0)
+            if max_age:
+                deleted += self.delete_photos(self.queue.expire(now - max_age))
+                self.queue.prune(now - max_age)
+            self.scan()
+            # a photo not yet added to the queue is protected by orphan_age
+            referenced = self.queue.referenced()
+            orphan_age = self.config.get('orphan_age', 3600)
+            for (path, (size, mtime)) in sorted(self.index.items()):
+                if os.path.basename(path) not in referenced and now - mtime > orphan_age:
+                    deleted += self.delete(path)
+            deleted += self.enforce_quota()
+            if deleted:
+                log.append("reaper: %d files deleted, %d files and %.1f MB kept, %.1f MB free"
+                           % (deleted, len(self.index), sum(x[0] for x in self.index.values()) / 1048576.0,
+                              self.free_space() / 1048576.0))
+            return deleted
+
+    def over_quota(self):
+        max_bytes = self.config.get('max_bytes', 0)
+        if max_bytes and sum(x[0] for x in self.index.values()) > max_bytes:
+            return True
+        return self.free_space() < self.config.get('min_free', 0)
+
+    def enforce_quota(self):
+        deleted = 0
+        if not self.over_quota():
+            return deleted
+        # unsent photos still have their e-mail copies, which are attached instead
+        (photodir, copydir) = self.dirs
+        originals = sorted((mtime, path) for (path, (size, mtime)) in self.index.items()
+                           if os.path.dirname(path) == photodir
+                           and os.path.join(copydir, os.path.basename(path)) in self.index)
+        for (mtime, path) in originals:
+            if not self.over_quota():
+                return deleted
+            log.append("over quota, deleting original " + path)
+            deleted += self.delete(path)
+        while self.over_quota():
+            oldest = self.queue.oldest_pending()
+            if oldest is None:
+                log.append("over quota with no unsent photos left to delete")
+                break
+            photos = self.queue.expire(oldest + 0.001)
+            log.append("over quota, %d unsent photos from %.0f expired" % (len(photos), oldest))
+            deleted += self.delete_photos(photos)
+        return deleted
+
+
+if __name__ == '__main__':
+    config = photoconf.load()
+    Reaper(config['storage'], SendQueue(config['paths']['queue']),
+           config['paths']['photopath'], config['paths']['emailcopies']).run()
@@ -4,23 +4,240 @@
 '''
 A script than sends emails with photos that is supposed to run continuously.
 
-Uses photoconfig.yaml for SMTP settings and locations of files with addresses and photo locations.
-Names of the files are e-mail addresses and their content are paths to images sent to the address.
+Uses photoconfig.yaml for SMTP settings and locations of the send queue and photos.
+Recipients and their photos are claimed from the SQLite queue (sendqueue.py) filled by the photobooth.
+The e-mail addresses are handed over on a Unix socket (handoff.py) and stored here, so sending starts at once.
+On SIGTERM no new message is started and the script exits once the messages in progress are sent.
 '''
 
+import base64
+import email.policy
 import os
+import random
+import signal
 import smtplib
+import tempfile
+import threading
+import uuid
+from email.header import Header
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from time import sleep
-
-import yaml
+from time import sleep, time
 
+from dirwatch import DirWatcher, IN_CLOSE_WRITE, IN_MODIFY, IN_MOVED_TO
+from handoff import HandoffServer
+import photoconf
+import photologging
+import photometrics
 from photologging import Logging
+from photometrics import metrics, timed
+from reaper import Reaper
+from sendqueue import SendQueue
 
 log = Logging()
 
+# bytes of attachment encoded at once, a multiple of 57 bytes that make one 76 character base64 line
+ENCODE_CHUNK = 57 * 1024
+# bytes of the message headers and the multipart boundaries, without the text and the attachments
+MESSAGE_OVERHEAD = 1024
+SEND_CHUNK = 64 * 1024
+
+
+class ConnectFailed(Exception):
+    ''' raised when the SMTP server cannot be reached or logged in to; the messages are not at fault '''
+
+
+def backoff(attempts, base, cap):
+    ''' returns delay in seconds before the next try: exponential with jitter, so retries do not come together '''
+    delay = min(cap, base * 2 ** min(attempts, 32))
+    return random.uniform(delay / 2.0, delay)
+
+
+def permanent(error):
+    ''' tells whether the error is a 5xx SMTP reply about the message, which no retry can fix '''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for (code, resp) in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPAuthenticationError)):
+        # refused sender or login are errors of the config, they are fixed without losing the messages
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def send_spooled(server, sender, recipient, spool):
+    ''' sends the message from the spool file, streaming it in chunks to the SMTP DATA command
+
+    Parameters
+    ------------
+    server : smtplib.SMTP
+        connected server
+    sender : str
+        address of the sender
+    recipient : str
+        address of the recipient
+    spool : file
+        binary file with the complete message with CRLF line endings
+    '''
+    server.ehlo_or_helo_if_needed()
+    (code, resp) = server.mail(sender)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    (code, resp) = server.rcpt(recipient)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({recipient: (code, resp)})
+    (code, resp) = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    spool.seek(0)
+    chunk = []
+    chunklen = 0
+    for line in spool:
+        if line.startswith(b'.'):
+            # transparency procedure of RFC 5321
+            line = b'.' + line
+        chunk.append(line)
+        chunklen += len(line)
+        if chunklen >= SEND_CHUNK:
+            server.send(b''.join(chunk))
+            chunk = []
+            chunklen = 0
+    chunk.append(b'.\r\n')
+    server.send(b''.join(chunk))
+    (code, resp) = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+
+
+class SmtpConnection:
+    ''' keeps one authenticated SMTP connection open across messages
+
+    Attributes
+    ------------
+    connect : callable
+        function returning a new authenticated smtplib server
+    max_messages : int
+        number of messages after which the connection is recycled
+    max_age : float
+        time in seconds after which the connection is recycled
+    idle_check : float
+        time in seconds of idleness after which the connection is checked with NOOP before use
+    server : smtplib.SMTP
+        current connection or None
+    opened : float
+        time when the current connection was opened
+    last_used : float
+        time of the last use of the current connection
+    sent : int
+        number of messages sent over the current connection
+
+    Methods
+    ------------
+    get()
+        returns a working connection, (re)connecting if needed
+    sent_message()
+        counts a message sent over the current connection
+    drop()
+        discards a broken connection without QUIT
+    close()
+        closes the connection with QUIT
+    '''
+
+    def __init__(self, connect, max_messages=50, max_age=600, idle_check=30):
+        self.connect = connect
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.idle_check = idle_check
+        self.server = None
+        self.opened = 0.0
+        self.last_used = 0.0
+        self.sent = 0
+
+    def get(self):
+        now = time()
+        if self.server and (self.sent >= self.max_messages or now - self.opened > self.max_age):
+            log.append("recycling connection after %d messages" % self.sent)
+            self.close()
+        if self.server and now - self.last_used > self.idle_check:
+            try:
+                alive = self.server.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                alive = False
+            if not alive:
+                log.append("connection lost while idle")
+                self.drop()
+        if not self.server:
+            start = time()
+            self.server = self.connect()
+            self.opened = time()
+            self.sent = 0
+            log.append("connected in %.3f s" % (self.opened - start))
+        self.last_used = time()
+        return self.server
+
+    def sent_message(self):
+        self.sent += 1
+        self.last_used = time()
+
+    def drop(self):
+        if self.server:
+            try:
+                self.server.close()
+            except OSError:
+                pass
+        self.server = None
+
+    def close(self):
+        if self.server:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        self.server = None
+
+
+class RateLimiter:
+    ''' token bucket limiting the number of messages sent per minute, shared by all send workers
+
+    Attributes
+    ------------
+    rate : float
+        allowed number of messages per minute, 0 means no limit
+    tokens : float
+        number of messages that can be sent right away
+    updated : float
+        time of the last token refill
+
+    Methods
+    ------------
+    acquire()
+        blocks until a message can be sent
+    '''
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate / 60.0)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) * 60.0 / self.rate
+            sleep(wait)
+
 
 class Sending:
 
@@ -29,41 +246,90 @@ class Sending:
         # globals1
         path = os.path.dirname(os.path.realpath(__file__))
         if not config:
-            with open("photoconfig.yaml", 'r') as stream:
-                config = yaml.full_load(stream)
-        self.config = config
-        self.filelistdir = os.path.join(path, config['paths']['addr'])
+            config = photoconf.load()
+            photoconf.watch()
+        self.config = photoconf.validate(config)
+        photoconf.subscribe(self.config_changed)
+        photologging.configure(**config['logging'])
         self.photodir = os.path.join(path, config['paths']['photopath'])
+        self.copydir = os.path.join(path, config['paths']['emailcopies'])
         emailpath = os.path.join(path, config['paths']['emailmessage'])
         with open(emailpath, 'r') as stream:
             self.emailmessage = stream.read()
+        self.metricsdir = os.path.join(path, config['paths']['metrics'])
+        queuepath = os.path.join(path, config['paths']['queue'])
+        self.queue = SendQueue(queuepath)
+        # abandoned sessions, orphans and quotas are handled in background
+        self.reaper = Reaper(config['storage'], SendQueue(queuepath), self.photodir, self.copydir)
+        self.queuename = os.path.basename(queuepath)
+        self.handoffpath = os.path.join(path, config['paths']['handoff'])
+        self.workers = config['smtp'].get('workers', 1)
+        self.ratelimiter = RateLimiter(config['smtp'].get('rate_per_minute', 0))
+        # with WAL the queue database is modified without closing, so IN_MODIFY is needed
+        self.watcher = DirWatcher(os.path.dirname(queuepath), mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY)
+        self.retry_delay = config['smtp'].get('retry_delay', 10)
+        self.wakeup = threading.Condition()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.sent_count = 0
+        self.sent_bytes = 0
+        self.config_generation = 0
+        self.connect_failures = 0
+        self.next_connect = 0.0
+        self.stopping = False
+        self.threads = []
+        self.handoff = None
+
+    def config_changed(self, changed):
+        smtp = self.config['smtp']
+        self.ratelimiter.rate = smtp['rate_per_minute']
+        self.retry_delay = smtp['retry_delay']
+        if any(name.startswith('smtp.') for name in changed):
+            # workers reconnect with the new settings after their current message
+            self.config_generation += 1
+
+    def new_connection(self):
+        return SmtpConnection(self.serverconnect,
+                              max_messages=self.config['smtp'].get('max_messages', 50),
+                              max_age=self.config['smtp'].get('max_age', 600),
+                              idle_check=self.config['smtp'].get('idle_check', 30))
 
     def smtp_connect(self):
-        smtpserver = 'smtp.' + self.config['smtp']['domain'] + ':465'
-        server = smtplib.SMTP_SSL(smtpserver)
+        smtp = self.config['smtp']
+        host = smtp['host'] or 'smtp.' + smtp['domain']
+        if smtp['tls'] == 'ssl':
+            server = smtplib.SMTP_SSL(host, smtp['port'], timeout=smtp['timeout'])
+        else:
+            server = smtplib.SMTP(host, smtp['port'], timeout=smtp['timeout'])
         server.ehlo()
-        server.login(self.config['smtp']['login'], self.config['smtp']['password'])
+        if smtp['tls'] == 'starttls':
+            server.starttls()
+            server.ehlo()
+        server.login(smtp['login'], smtp['password'])
         return server
 
-    def create_message(self, filelistpath=""):
-        log.append(filelistpath)
-        if not os.path.isfile(filelistpath):
-            log.append("file %s not exist" % filelistpath)
+    def attachment_path(self, photo):
+        # e-mail sized copy if it was made, the original photo otherwise
+        copy = os.path.join(self.copydir, photo)
+        if os.path.exists(copy):
+            return copy
+        return os.path.join(self.photodir, photo)
+
+    @timed('create_message')
+    def create_message(self, recipient, photos):
+        '''builds the whole message in memory; kept as a reference for bench_mail.py'''
+        log.append("recipient " + recipient)
+        lines = [self.attachment_path(x) for x in photos]
+        if not lines:
             return ""
 
-        log.append("recipient " + os.path.split(filelistpath)[1])
         outer = MIMEMultipart()
         outer['Subject'] = 'Zdjęcia z Pikniku Naukowego'
-        outer['To'] = os.path.split(filelistpath)[1]
+        outer['To'] = recipient
         outer['From'] = self.config['smtp']['login'] + '@' + self.config['smtp']['domain']
         outer.preamble = 'You will not see this in a MIME-aware mail reader.\n'
 
-        with open(filelistpath, "r") as file:
-            lines = file.read().splitlines()
-        lines = [os.path.join(self.photodir, x.strip()) for x in lines if x.strip()]
-        if not lines:
-            return ""
-
         for path in lines:
             log.append("adding %s to email" % path)
             if not os.path.exists(path):
@@ -81,78 +347,304 @@ class Sending:
         composed = outer.as_string()
         return composed
 
-    def delete_files(self, filelistpath):
-        if not os.path.exists(filelistpath):
-            return
-        log.append("deleting " + filelistpath)
-        with open(filelistpath, "r") as file:
-            lines = file.read().splitlines()
-        lines = [os.path.join(self.photodir, x.strip()) for x in lines if x.strip()]
+    def split(self, photos):
+        ''' splits the photos into parts of messages under the size cap, keeping their order
+
+        Returns
+        list
+            lists of photo names, a photo bigger than the cap is sent alone
+        '''
+        cap = self.config['smtp']['max_message_bytes']
+        parts = []
+        size = cap
+        for photo in photos:
+            path = self.attachment_path(photo)
+            # base64 with CRLF every 76 characters, MIME headers of the attachment
+            encoded = (os.path.getsize(path) if os.path.exists(path) else 0) * 4 // 3 * 78 // 76 + 256
+            if not cap or size + encoded <= cap:
+                size += encoded
+                if parts:
+                    parts[-1].append(photo)
+                    continue
+            parts.append([photo])
+            size = MESSAGE_OVERHEAD + len(self.emailmessage) + encoded
+        return parts
+
+    @timed('spool_message')
+    def spool_message(self, recipient, photos, spool, part=''):
+        '''writes the message into the spool file, encoding the attachments chunk by chunk
+
+        Unlike create_message, the message is never held in memory as a whole.
+
+        Parameters
+        ------------
+        recipient : str
+            address of the recipient
+        photos : list
+            names of the photo files
+        spool : file
+            binary file opened for writing and reading
+        part : str, optional
+            e.g. "1/2", added to the subject of a message split into parts
+
+        Returns
+        int
+            size of the message in bytes, 0 if there was nothing to send
+        '''
+        log.append("recipient " + recipient)
+        lines = [self.attachment_path(x) for x in photos]
+        if not lines:
+            return 0
+
+        boundary = '=' * 15 + uuid.uuid4().hex + '=='
+        sender = self.config['smtp']['login'] + '@' + self.config['smtp']['domain']
+        subject = 'Zdjęcia z Pikniku Naukowego' + (' (' + part + ')' if part else '')
+        headers = ['Content-Type: multipart/mixed; boundary="%s"' % boundary,
+                   'MIME-Version: 1.0',
+                   'Subject: ' + Header(subject, 'utf-8').encode(),
+                   'To: ' + recipient,
+                   'From: ' + sender,
+                   '',
+                   'You will not see this in a MIME-aware mail reader.']
+        spool.write(('\r\n'.join(headers) + '\r\n').encode('ascii'))
+        delimiter = ('--' + boundary + '\r\n').encode('ascii')
         for path in lines:
-            if os.path.exists(path):
-                os.remove(path)
-        os.remove(filelistpath)
-
-    def get_filename(self, filelist):
-        log.append("get filename")
-        for file in filelist:
-            if file.strip()[0:8] == "!garbage":
-                log.append("garbage!")
-                filepath = os.path.join(self.filelistdir, file)
-                self.delete_files(filepath)
+            log.append("adding %s to email" % path)
+            if not os.path.exists(path):
                 continue
-            if file.strip()[0] != "!":
-                return file
-        return ""
+            spool.write(delimiter)
+            spool.write(('Content-Type: image/jpg\r\n'
+                         'MIME-Version: 1.0\r\n'
+                         'Content-Transfer-Encoding: base64\r\n'
+                         'Content-Disposition: attachment; filename="%s"\r\n\r\n'
+                         % os.path.split(path)[-1]).encode('ascii'))
+            with open(path, 'rb') as fp:
+                while True:
+                    data = fp.read(ENCODE_CHUNK)
+                    if not data:
+                        break
+                    spool.write(base64.encodebytes(data).replace(b'\n', b'\r\n'))
+            log.append("file " + path + " added")
+        spool.write(delimiter)
+        body = MIMEText(self.emailmessage, 'html')
+        spool.write(body.as_bytes(policy=email.policy.compat32.clone(linesep='\r\n')))
+        spool.write(('\r\n--' + boundary + '--\r\n').encode('ascii'))
+        spool.flush()
+        return spool.tell()
+
+    def delete_photos(self, photos):
+        for photo in photos:
+            for path in (os.path.join(self.photodir, photo), os.path.join(self.copydir, photo)):
+                if os.path.exists(path):
+                    log.append("deleting " + path)
+                    os.remove(path)
 
     def serverconnect(self):
-        server = None
-        while not server:
-            try:
-                log.append("connecting")
-                server = self.smtp_connect()
-            except smtplib.SMTPException as e:
-                log.append(" ".join(str(e).splitlines()))
-                sleep(1)
-            except OSError as e:
-                log.append(" ".join(str(e).splitlines()))
-                sleep(10)
+        # connection failures are shared by the workers, so a server that is down is not hammered by all of them
+        with self.lock:
+            wait = self.next_connect - time()
+        if wait > 0:
+            sleep(wait)
+        try:
+            log.append("connecting")
+            server = self.smtp_connect()
+        except (smtplib.SMTPException, OSError) as e:
+            with self.lock:
+                self.connect_failures += 1
+                delay = backoff(self.connect_failures - 1, 1, self.config['smtp']['connect_max_delay'])
+                self.next_connect = time() + delay
+            log.append("connection failed %d times, next try in %.0f s: %s"
+                       % (self.connect_failures, delay, " ".join(str(e).splitlines())))
+            raise ConnectFailed(str(e))
+        with self.lock:
+            self.connect_failures = 0
         return server
 
+    @timed('sendmail')
+    def send(self, connection, recipient, spool, size):
+        sender = self.config['smtp']['login'] + '@' + self.config['smtp']['domain']
+        self.ratelimiter.acquire()
+        start = time()
+        server = connection.get()
+        connected = time()
+        try:
+            send_spooled(server, sender, recipient, spool)
+        except smtplib.SMTPServerDisconnected:
+            log.append("server disconnected, reconnecting")
+            connection.drop()
+            server = connection.get()
+            connected = time()
+            send_spooled(server, sender, recipient, spool)
+        connection.sent_message()
+        log.append("connect %.3f s, send %.3f s, %d bytes" % (connected - start, time() - connected, size))
+        with self.lock:
+            self.sent_count += 1
+            self.sent_bytes += size
+
+    def process(self, connection, job):
+        with tempfile.TemporaryFile(dir=self.photodir) as spool:
+            self.transmit(connection, job, spool)
+
+    def transmit(self, connection, job, spool):
+        try:
+            if not job.photos and job.sent:
+                # all the parts were sent before an interruption
+                self.delete_photos(self.queue.complete(job.ids))
+                return
+            parts = self.split(job.photos)
+            if not parts:
+                log.append("not composed")
+                self.queue.fail(job.ids, "not composed")
+                metrics.inc('emails_failed')
+                return
+            if len(parts) > 1:
+                log.append("%d photos to %s split into %d messages" % (len(job.photos), job.email, len(parts)))
+            for (number, photos) in enumerate(parts, 1):
+                spool.seek(0)
+                spool.truncate()
+                part = "%d/%d" % (number, len(parts)) if len(parts) > 1 else ''
+                size = self.spool_message(job.email, photos, spool, part)
+                log.append("sending to " + job.email)
+                self.send(connection, job.email, spool, size)
+                metrics.inc('messages_sent')
+                metrics.inc('bytes_sent', size)
+                if number < len(parts):
+                    # a retry after a failure of a later part sends only the rest
+                    self.queue.mark_sent(job.ids, photos)
+            self.delete_photos(self.queue.complete(job.ids))
+            metrics.inc('emails_sent')
+        except ConnectFailed as e:
+            # tried again once the server can be reached, not counted as an attempt of the message
+            with self.lock:
+                delay = max(0, self.next_connect - time())
+            self.queue.retry(job.ids, str(e), delay, count=False)
+        except Exception as e:
+            log.append(" ".join(str(e).splitlines()))
+            if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                connection.drop()
+            self.failed(job, e)
+
+    def failed(self, job, error):
+        smtp = self.config['smtp']
+        if permanent(error):
+            log.append("permanent error, not sent to " + job.email)
+            self.delete_photos(self.queue.fail(job.ids, str(error)))
+            metrics.inc('emails_failed')
+        elif job.attempts + 1 >= smtp['max_attempts']:
+            log.append("%d attempts failed, %s quarantined" % (job.attempts + 1, job.email))
+            self.queue.quarantine(job.ids, str(error))
+            metrics.inc('emails_quarantined')
+        else:
+            delay = backoff(job.attempts, self.retry_delay, smtp['retry_max_delay'])
+            log.append("attempt %d failed, next in %.0f s" % (job.attempts + 1, delay))
+            self.queue.retry(job.ids, str(error), delay)
+            metrics.inc('emails_retried')
+
+    def handoff_received(self, message):
+        # the photobooth writes the queue itself when this raises or does not answer
+        if not isinstance(message.get('session'), int) or not message.get('email'):
+            raise ValueError("session and email expected")
+        if self.queue.add_recipient(message['session'], message['email'], message.get('photos', [])):
+            metrics.inc('handoffs')
+            self.notify()
+        else:
+            log.append("session %d already queued for %s" % (message['session'], message['email']))
+
+    def notify(self):
+        with self.wakeup:
+            self.generation += 1
+            self.wakeup.notify_all()
+
+    def idle_timeout(self):
+        due = self.queue.next_due(self.config['smtp']['quiet_window'])
+        if due is None:
+            return 60
+        return min(60, max(0.1, due - time()))
+
+    def worker(self):
+        connection = self.new_connection()
+        config_generation = self.config_generation
+        while not self.stopping:
+            if config_generation != self.config_generation:
+                config_generation = self.config_generation
+                connection.close()
+                connection = self.new_connection()
+            with self.wakeup:
+                generation = self.generation
+            job = self.queue.claim(self.config['smtp']['quiet_window'])
+            if not job:
+                with self.wakeup:
+                    # sleeps until the queue changes or a retry is due
+                    if generation == self.generation and not self.stopping:
+                        self.wakeup.wait(self.idle_timeout())
+                continue
+            with self.lock:
+                self.inflight += 1
+            try:
+                self.process(connection, job)
+            finally:
+                with self.lock:
+                    self.inflight -= 1
+        connection.close()
+
+    def report(self, interval, pending):
+        with self.lock:
+            count, size = self.sent_count, self.sent_bytes
+            self.sent_count, self.sent_bytes = 0, 0
+            inflight = self.inflight
+        log.append("throughput %.2f msg/min, %.1f kB/s, queue depth %d, in progress %d"
+                   % (count * 60.0 / interval, size / 1024.0 / interval, pending, inflight))
+
     def run(self):
-        while True:
-            log.append("sendphotos")
-            sleep(0.5)
-            filename = self.get_filename(os.listdir(self.filelistdir))
-            log.append(filename)
-            if filename:
-                server = self.serverconnect()
-                filelistpath = os.path.join(self.filelistdir, filename)
-                composed = self.create_message(filelistpath)
-                try:
-                    if composed:
-                        log.append("sending to " + filename)
-                        server.sendmail(self.config['smtp']['login'] + '@' + self.config['smtp']['domain'],
-                                        filename, composed)
-                        self.delete_files(filelistpath)
-                    else:
-                        log.append("not composed")
-                        new_filelistpath = os.path.join(self.filelistdir, "!" + filename)
-                        os.rename(filelistpath, new_filelistpath)
-                except smtplib.SMTPServerDisconnected as e:
-                    log.append(" ".join(str(e).splitlines()))
-                    continue
-                except smtplib.SMTPRecipientsRefused as e:
-                    log.append(" ".join(str(e).splitlines()))
-                    self.delete_files(filelistpath)
-                    continue
-                except OSError as e:
-                    log.append(" ".join(str(e).splitlines()))
-                    continue
-                except Exception as e:
-                    log.append(" ".join(str(e).splitlines()))
-                    continue
-                server.quit()
+        photometrics.start_export(self.config.get('metrics', {}), 'sendphotos', self.metricsdir)
+        metrics.set('queue_depth', self.queue.pending_count)
+        metrics.set('inflight', lambda: self.inflight)
+        self.queue.recover()
+        self.reaper.start()
+        try:
+            self.handoff = HandoffServer(self.handoffpath, self.handoff_received)
+            self.handoff.start()
+        except OSError as e:
+            # the photobooth writes the queue itself, which the watcher below notices
+            log.append("no handoff socket: " + str(e))
+            self.handoff = None
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        stats_interval = self.config['smtp'].get('stats_interval', 60)
+        last_report = time()
+        self.watcher.start()
+        # signal handlers can be installed only in the main thread; run from another thread
+        # (e.g. by bench_sender.py), the caller handles the signals
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            while True:
+                name = self.watcher.get(timeout=max(0.0, last_report + stats_interval - time()))
+                if name and name.startswith(self.queuename):
+                    # the photobooth or a worker changed the queue
+                    self.notify()
+                if time() - last_report >= stats_interval:
+                    self.report(time() - last_report, self.queue.pending_count())
+                    last_report = time()
+        finally:
+            self.stop()
+
+    def terminate(self, signum, frame):
+        # interrupts the wait of the main loop, which stops the workers on the way out
+        raise SystemExit(0)
+
+    def stop(self):
+        log.append("stopping, %d messages in progress" % self.inflight)
+        # the photobooth queues the addresses itself while the socket is gone
+        if self.handoff:
+            self.handoff.close()
+        self.stopping = True
+        self.notify()
+        for thread in self.threads:
+            thread.join()
+        log.append("stopped, %d recipients left in the queue" % self.queue.pending_count())
 
 
 if __name__ == '__main__':
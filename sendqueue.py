@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+Durable queue of photo sessions and their e-mail recipients, shared by the photobooth and the sender.
+
+The queue is a SQLite database in WAL mode, so the photobooth can add sessions while the sender claims them.
+A session is "open" while photos are taken, "closed" once a recipient is given and "abandoned" when
+a new session starts without an e-mail. Recipients are "pending", "sending", "sent", "failed",
+or "quarantined" after too many failed attempts; their photos are kept until they are released.
+Run as a script with --migrate to import an old addr/ directory with files named after e-mail addresses
+(once, when upgrading), or with --release to return the quarantined recipients to the queue.
+'''
+
+import os
+import sqlite3
+import sys
+import threading
+from collections import namedtuple
+from time import time
+
+import photoconf
+from photologging import Logging
+
+log = Logging()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'open'
+);
+CREATE INDEX IF NOT EXISTS sessions_state ON sessions(state);
+CREATE TABLE IF NOT EXISTS photos (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    filename TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_session ON photos(session_id);
+CREATE TABLE IF NOT EXISTS recipients (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    email TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_retry REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS recipients_state ON recipients(state, next_retry);
+CREATE INDEX IF NOT EXISTS recipients_email ON recipients(email, state);
+CREATE INDEX IF NOT EXISTS recipients_session ON recipients(session_id, state);
+CREATE TABLE IF NOT EXISTS sent_photos (
+    recipient_id INTEGER NOT NULL REFERENCES recipients(id),
+    filename TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sent_photos_recipient ON sent_photos(recipient_id);
+CREATE TABLE IF NOT EXISTS addresses (
+    email TEXT PRIMARY KEY,
+    next_retry REAL NOT NULL,
+    newest REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS addresses_next_retry ON addresses(next_retry);
+CREATE INDEX IF NOT EXISTS addresses_newest ON addresses(newest, next_retry);
+'''
+
+# a claimed recipient: e-mail address, ids of the recipient rows, names of the photos to send
+# and of the photos already sent to the address in an earlier part
+Job = namedtuple('Job', ['email', 'ids', 'photos', 'attempts', 'sent'])
+
+# a pending recipient is newer than the quiet window while it was added and not tried yet;
+# one put back after a failed connection is due at its next_retry
+NEWEST = "MAX(CASE WHEN attempts=0 AND next_retry<=updated THEN updated ELSE 0 END)"
+# the addresses table keeps, for every address with pending recipients, their earliest next_retry and NEWEST,
+# so claiming and waiting are indexed lookups instead of grouping all the pending recipients.
+# An address with newest>0 has a recipient with next_retry<=newest, so it is due at newest+quiet;
+# otherwise it is due at next_retry.
+ADDRESS = "SELECT email, MIN(next_retry), " + NEWEST + " FROM recipients WHERE state='pending'"
+
+
+class SendQueue:
+    ''' SQLite queue of sessions, photos and recipients
+
+    Every thread gets its own connection to the database.
+
+    Attributes
+    ------------
+    path : str
+        location of the database file
+
+    Methods
+    ------------
+    open_session()
+        starts a new session, abandoning sessions left open without recipient; returns session id
+    add_photo(session_id, filename)
+        adds photo file name to the session
+    add_recipient(session_id, email, photos=())
+        closes the session and queues it for sending to the address, adding the photos not in the session yet;
+        returns False when the address was already given for the session
+    claim(quiet=0)
+        marks all the due pending recipients with the same address as being sent and returns them as a Job;
+        an address is not claimed until quiet seconds passed since its last recipient was added
+    mark_sent(ids, photos)
+        records the photos sent to the recipients in one part of a split message
+    complete(ids)
+        marks recipients as sent; returns photos no longer needed by any unsent recipient
+    fail(ids, error='')
+        marks recipients as failed; returns photos no longer needed by any unsent recipient
+    retry(ids, error='', delay=0, count=True)
+        returns recipients to the queue to be claimed after delay seconds, counting the attempt if count
+    quarantine(ids, error='')
+        sets recipients aside after too many failed attempts
+    release()
+        returns the quarantined recipients to the queue; returns their number
+    recover()
+        returns recipients left in the "sending" state by a crash to the queue
+    abandoned()
+        returns list of (session_id, photos) for the abandoned sessions
+    purge(session_id)
+        removes the session with its photos and recipients from the database
+    referenced()
+        returns set of photo file names still needed: of open sessions and of unsent or quarantined recipients
+    expire(cutoff)
+        fails pending and quarantined recipients of sessions created before cutoff; returns photos no longer needed
+    oldest_pending()
+        returns creation time of the oldest session with a pending recipient, or None
+    prune(cutoff)
+        removes sessions finished before cutoff from the database
+    pending_count()
+        returns number of pending recipients
+    next_due(quiet=0)
+        returns the earliest time at which a pending recipient can be claimed, or None
+    migrate(addrdir)
+        imports the files of the old protocol from addr/ directory and removes them
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        db = self.connection()
+        upgrade = not db.execute("SELECT 1 FROM sqlite_master WHERE name='addresses'").fetchone()
+        db.executescript(SCHEMA)
+        if upgrade:
+            # a queue made before the addresses table
+            with self.transaction() as db:
+                self._rebuild(db)
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def transaction(self):
+        return Transaction(self.connection())
+
+    def open_session(self):
+        with self.transaction() as db:
+            db.execute("UPDATE sessions SET state='abandoned' WHERE state='open'")
+            return db.execute("INSERT INTO sessions (created) VALUES (?)", (time(),)).lastrowid
+
+    def add_photo(self, session_id, filename):
+        with self.transaction() as db:
+            db.execute("INSERT INTO photos (session_id, filename) VALUES (?, ?)", (session_id, filename))
+
+    def add_recipient(self, session_id, email, photos=()):
+        now = time()
+        with self.transaction() as db:
+            # a handoff repeated after a lost acknowledgement is stored once
+            if db.execute("SELECT 1 FROM recipients WHERE session_id=? AND email=?", (session_id, email)).fetchone():
+                return False
+            known = set(x[0] for x in db.execute("SELECT filename FROM photos WHERE session_id=?", (session_id,)))
+            db.executemany("INSERT INTO photos (session_id, filename) VALUES (?, ?)",
+                           [(session_id, x) for x in photos if x not in known])
+            db.execute("UPDATE sessions SET state='closed' WHERE id=?", (session_id,))
+            db.execute("INSERT INTO recipients (session_id, email, next_retry, updated) VALUES (?, ?, ?, ?)",
+                       (session_id, email, now, now))
+            self._refresh(db, [email])
+            return True
+
+    def claim(self, quiet=0):
+        now = time()
+        with self.transaction() as db:
+            row = db.execute("SELECT email FROM addresses WHERE next_retry<=? AND newest<=? "
+                             "ORDER BY next_retry LIMIT 1", (now, now - quiet)).fetchone()
+            if not row:
+                return None
+            email = row[0]
+            # the unary plus keeps the planner on the address index instead of scanning all the due recipients
+            rows = db.execute("SELECT id, session_id, attempts FROM recipients "
+                              "WHERE email=? AND state='pending' AND +next_retry<=? ORDER BY id",
+                              (email, now)).fetchall()
+            ids = [x[0] for x in rows]
+            db.executemany("UPDATE recipients SET state='sending', updated=? WHERE id=?", [(now, x) for x in ids])
+            self._refresh(db, [email])
+            photos = []
+            sent = []
+            for (recipient_id, session_id, attempts) in rows:
+                done = set(x[0] for x in db.execute("SELECT filename FROM sent_photos WHERE recipient_id=?",
+                                                    (recipient_id,)))
+                for (filename,) in db.execute("SELECT filename FROM photos WHERE session_id=? ORDER BY id",
+                                              (session_id,)):
+                    if filename in done:
+                        sent.append(filename)
+                    elif filename not in photos:
+                        photos.append(filename)
+            return Job(email, ids, photos, max(x[2] for x in rows), sent)
+
+    def mark_sent(self, ids, photos):
+        with self.transaction() as db:
+            db.executemany("INSERT INTO sent_photos (recipient_id, filename) VALUES (?, ?)",
+                           [(x, y) for x in ids for y in photos])
+
+    def complete(self, ids):
+        return self.finish(ids, 'sent', None)
+
+    def fail(self, ids, error=''):
+        return self.finish(ids, 'failed', error)
+
+    def finish(self, ids, state, error):
+        now = time()
+        with self.transaction() as db:
+            db.executemany("UPDATE recipients SET state=?, error=?, updated=? WHERE id=?",
+                           [(state, error, now, x) for x in ids])
+            self._refresh(db, self._emails(db, ids))
+            sessions = set()
+            for recipient_id in ids:
+                sessions.update(x[0] for x in db.execute("SELECT session_id FROM recipients WHERE id=?",
+                                                         (recipient_id,)))
+            done = []
+            for session_id in sessions:
+                unsent = db.execute("SELECT 1 FROM recipients WHERE session_id=? AND state IN ('pending', 'sending', "
+                                    "'quarantined') LIMIT 1", (session_id,)).fetchone()
+                if not unsent:
+                    done += [x[0] for x in db.execute("SELECT filename FROM photos WHERE session_id=?",
+                                                      (session_id,))]
+            return done
+
+    def retry(self, ids, error='', delay=0, count=True):
+        now = time()
+        with self.transaction() as db:
+            db.executemany("UPDATE recipients SET state='pending', attempts=attempts+?, error=?, next_retry=?, "
+                           "updated=? WHERE id=?", [(int(count), error, now + delay, now, x) for x in ids])
+            self._refresh(db, self._emails(db, ids))
+
+    def quarantine(self, ids, error=''):
+        now = time()
+        with self.transaction() as db:
+            db.executemany("UPDATE recipients SET state='quarantined', attempts=attempts+1, error=?, updated=? "
+                           "WHERE id=?", [(error, now, x) for x in ids])
+
+    def release(self):
+        now = time()
+        with self.transaction() as db:
+            count = db.execute("UPDATE recipients SET state='pending', attempts=0, next_retry=?, updated=? "
+                               "WHERE state='quarantined'", (now, now)).rowcount
+            self._rebuild(db)
+            return count
+
+    def recover(self):
+        with self.transaction() as db:
+            count = db.execute("UPDATE recipients SET state='pending' WHERE state='sending'").rowcount
+            self._rebuild(db)
+        if count:
+            log.append("%d interrupted recipients returned to the queue" % count)
+
+    def abandoned(self):
+        db = self.connection()
+        sessions = [x[0] for x in db.execute("SELECT id FROM sessions WHERE state='abandoned'")]
+        return [(x, [y[0] for y in db.execute("SELECT filename FROM photos WHERE session_id=?", (x,))])
+                for x in sessions]
+
+    def purge(self, session_id):
+        with self.transaction() as db:
+            emails = [x[0] for x in db.execute("SELECT DISTINCT email FROM recipients WHERE session_id=?",
+                                               (session_id,))]
+            db.execute("DELETE FROM sent_photos WHERE recipient_id IN "
+                       "(SELECT id FROM recipients WHERE session_id=?)", (session_id,))
+            db.execute("DELETE FROM recipients WHERE session_id=?", (session_id,))
+            db.execute("DELETE FROM photos WHERE session_id=?", (session_id,))
+            db.execute("DELETE FROM sessions WHERE id=?", (session_id,))
+            self._refresh(db, emails)
+
+    def referenced(self):
+        db = self.connection()
+        rows = db.execute("SELECT filename FROM photos WHERE session_id IN "
+                          "(SELECT id FROM sessions WHERE state='open' UNION "
+                          "SELECT session_id FROM recipients WHERE state IN ('pending', 'sending', 'quarantined'))")
+        return set(x[0] for x in rows)
+
+    def expire(self, cutoff):
+        ids = [x[0] for x in self.connection().execute(
+            "SELECT recipients.id FROM recipients JOIN sessions ON sessions.id=recipients.session_id "
+            "WHERE recipients.state IN ('pending', 'quarantined') AND sessions.created<?", (cutoff,))]
+        if not ids:
+            return []
+        return self.finish(ids, 'failed', 'expired')
+
+    def oldest_pending(self):
+        return self.connection().execute(
+            "SELECT MIN(sessions.created) FROM sessions JOIN recipients ON sessions.id=recipients.session_id "
+            "WHERE recipients.state='pending'").fetchone()[0]
+
+    def prune(self, cutoff):
+        with self.transaction() as db:
+            sessions = [x[0] for x in db.execute(
+                "SELECT id FROM sessions WHERE state='closed' AND created<? AND NOT EXISTS "
+                "(SELECT 1 FROM recipients WHERE session_id=sessions.id AND "
+                "(state IN ('pending', 'sending', 'quarantined') OR updated>=?))", (cutoff, cutoff))]
+            for session_id in sessions:
+                db.execute("DELETE FROM sent_photos WHERE recipient_id IN "
+                           "(SELECT id FROM recipients WHERE session_id=?)", (session_id,))
+                db.execute("DELETE FROM recipients WHERE session_id=?", (session_id,))
+                db.execute("DELETE FROM photos WHERE session_id=?", (session_id,))
+                db.execute("DELETE FROM sessions WHERE id=?", (session_id,))
+        return len(sessions)
+
+    def pending_count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM recipients WHERE state='pending'").fetchone()[0]
+
+    def next_due(self, quiet=0):
+        db = self.connection()
+        retry = db.execute("SELECT MIN(next_retry) FROM addresses WHERE newest=0").fetchone()[0]
+        newest = db.execute("SELECT MIN(newest) FROM addresses WHERE newest>0").fetchone()[0]
+        due = [x for x in (retry, newest + quiet if newest is not None else None) if x is not None]
+        return min(due) if due else None
+
+    def _emails(self, db, ids):
+        return set(db.execute("SELECT email FROM recipients WHERE id=?", (x,)).fetchone()[0] for x in ids)
+
+    def _refresh(self, db, emails):
+        ''' updates the due times of the addresses after their pending recipients changed '''
+        for email in emails:
+            row = db.execute(ADDRESS + " AND email=?", (email,)).fetchone()
+            if row[1] is None:
+                db.execute("DELETE FROM addresses WHERE email=?", (email,))
+            else:
+                db.execute("INSERT OR REPLACE INTO addresses (email, next_retry, newest) VALUES (?, ?, ?)",
+                           (email, row[1], row[2]))
+
+    def _rebuild(self, db):
+        db.execute("DELETE FROM addresses")
+        db.execute("INSERT INTO addresses (email, next_retry, newest) " + ADDRESS + " GROUP BY email")
+
+    def migrate(self, addrdir):
+        dbname = os.path.basename(self.path)
+        imported = 0
+        for name in sorted(os.listdir(addrdir)):
+            filepath = os.path.join(addrdir, name)
+            if name.startswith(dbname) or not os.path.isfile(filepath):
+                continue
+            # only the names the old photobooth wrote, other files may belong to other processes
+            if not (name == "!tmp" or name.startswith("!garbage") or "@" in name):
+                continue
+            with open(filepath, "r") as file:
+                photos = [x.strip() for x in file.read().splitlines() if x.strip()]
+            now = time()
+            with self.transaction() as db:
+                if name.startswith("!garbage") or name == "!tmp":
+                    state, email, recipient_state = 'abandoned', '', None
+                elif name.startswith("!"):
+                    state, email, recipient_state = 'closed', name[1:], 'failed'
+                else:
+                    state, email, recipient_state = 'closed', name, 'pending'
+                session_id = db.execute("INSERT INTO sessions (created, state) VALUES (?, ?)",
+                                        (os.path.getmtime(filepath), state)).lastrowid
+                db.executemany("INSERT INTO photos (session_id, filename) VALUES (?, ?)",
+                               [(session_id, x) for x in photos])
+                if recipient_state:
+                    db.execute("INSERT INTO recipients (session_id, email, state, next_retry, updated) "
+                               "VALUES (?, ?, ?, ?, ?)", (session_id, email, recipient_state, now, now))
+                    self._refresh(db, [email])
+            os.remove(filepath)
+            imported += 1
+        if imported:
+            log.append("imported %d files from %s" % (imported, addrdir))
+
+
+class Transaction:
+    ''' context manager running statements in a single write transaction, committed on success '''
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.db.execute('ROLLBACK')
+        else:
+            self.db.execute('COMMIT')
+
+
+if __name__ == '__main__':
+    config = photoconf.load()
+    queue = SendQueue(config['paths']['queue'])
+    if '--release' in sys.argv[1:]:
+        log.append("%d quarantined recipients released" % queue.release())
+    elif '--migrate' in sys.argv[1:]:
+        queue.migrate(config['paths']['addr'])
+    else:
+        print("usage: %s --migrate | --release" % sys.argv[0])
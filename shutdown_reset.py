@@ -2,10 +2,11 @@
 
 import os
 from time import sleep
-import yaml
 
 import RPi.GPIO as gpio
 
+import photoconf
+import photologging
 from photologging import Logging
 
 
@@ -35,9 +36,9 @@ class Counter:
 class ShutdownReset:
     def __init__(self, config=None):
         if not config:
-            with open("photoconfig.yaml", 'r') as stream:
-                config = yaml.full_load(stream)
+            config = photoconf.load()
         #self.config = config
+        photologging.configure(**config['logging'])
         self.cnt = Counter(config["pin_reset_btn"])
 
     def run(self):
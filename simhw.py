@@ -0,0 +1,200 @@
+'''
+Simulated hardware for running the photobooth without RaspberryPi.
+
+Selected with "backend: sim" in photoconfig.yaml. SimGPIO stands in for the RPi.GPIO module and presses
+the buttons on a schedule, PiCamera stands in for picamera.PiCamera, accepts overlays and writes synthetic JPEGs.
+All the delays use boothclock, so the simulation can run faster than real time.
+'''
+
+import io
+import threading
+from itertools import cycle
+
+from PIL import Image
+
+from boothclock import sleep
+
+# settings of the simulated camera, changed with configure()
+settings = {
+    'capture_time': 0.5,  # seconds a capture takes
+    'mode_switch_time': 0.4,  # seconds a still capture takes to switch the sensor mode and settle exposure
+}
+
+
+def configure(config):
+    settings.update((key, config[key]) for key in settings if key in config)
+
+
+class SimGPIO:
+    ''' stand-in for the RPi.GPIO module
+
+    Every event detection added for a pin is followed by a simulated press after the next delay
+    from press_delays, i.e. the visitor presses the button that much later.
+
+    Attributes
+    ------------
+    press_delays : iterator
+        cycle of delays in seconds between the start of the event detection and the press
+    press_length : float
+        time in seconds for which the pin stays low after the press
+    levels : dict
+        pin -> current level
+    callbacks : dict
+        pin -> callback of the event detection
+    presses : int
+        number of simulated presses
+
+    Methods
+    ------------
+    setmode(mode), setup(pin, direction, pull_up_down=None, initial=0), input(pin), output(pin, value),
+    add_event_detect(pin, edge, callback=None, bouncetime=0), remove_event_detect(pin), cleanup(pin=None)
+        same as in RPi.GPIO
+    '''
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    FALLING = 32
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, config):
+        self.press_delays = cycle(config.get('press_delays', [2.0]))
+        self.press_length = config.get('press_length', 0.2)
+        self.levels = {}
+        self.callbacks = {}
+        self.presses = 0
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=0):
+        self.levels[pin] = self.HIGH if direction == self.IN else initial
+
+    def input(self, pin):
+        return self.levels.get(pin, self.HIGH)
+
+    def output(self, pin, value):
+        self.levels[pin] = value
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=0):
+        self.callbacks[pin] = callback
+        threading.Thread(target=self.press, args=(pin, callback, next(self.press_delays)), daemon=True).start()
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        pass
+
+    def press(self, pin, callback, delay):
+        sleep(delay)
+        if self.callbacks.get(pin) is not callback:
+            # the detection was removed or replaced in the meantime
+            return
+        self.presses += 1
+        self.levels[pin] = self.LOW
+        callback(pin)
+        sleep(self.press_length)
+        self.levels[pin] = self.HIGH
+
+
+class SimRenderer:
+    ''' stand-in for picamera.PiOverlayRenderer '''
+
+    def __init__(self, source, size, layer=0, alpha=255):
+        self.source = source
+        self.size = size
+        self.layer = layer
+        self.alpha = alpha
+
+    def update(self, source):
+        self.source = source
+
+
+class SimPreview:
+    ''' stand-in for picamera.PiPreviewRenderer '''
+
+    def __init__(self, resolution=None):
+        self.resolution = resolution
+        self.alpha = 255
+
+
+class PiCamera:
+    ''' stand-in for picamera.PiCamera
+
+    Attributes
+    ------------
+    overlays : list
+        renderers currently added
+    captures : int
+        number of photos captured
+    jpegs : dict
+        resolution -> synthetic JPEG bytes, made once per resolution
+
+    Methods
+    ------------
+    start_preview(resolution=None, **kwargs), stop_preview(), add_overlay(source, size=None, layer=0, alpha=255,
+    **kwargs), remove_overlay(renderer), capture(output, format='jpeg', use_video_port=False, **kwargs), close()
+        same as in picamera.PiCamera
+    '''
+
+    CAPTURE_TIMEOUT = 60
+
+    def __init__(self):
+        self.rotation = 0
+        self.annotate_text_size = 32
+        self.annotate_text = ""
+        self.image_effect = 'none'
+        self.resolution = (1920, 1080)
+        self.sensor_mode = 0
+        self.exposure_mode = 'auto'
+        self.exposure_speed = 20000
+        self.shutter_speed = 0
+        self.awb_mode = 'auto'
+        self.awb_gains = (1.5, 1.2)
+        self.preview = None
+        self.overlays = []
+        self.captures = 0
+        self.jpegs = {}
+
+    def start_preview(self, resolution=None, **kwargs):
+        self.preview = SimPreview(resolution)
+        return self.preview
+
+    def stop_preview(self):
+        self.preview = None
+
+    def add_overlay(self, source, size=None, layer=0, alpha=255, **kwargs):
+        padded = ((size[0] + 31) // 32 * 32) * ((size[1] + 15) // 16 * 16) * 3
+        if len(source) != padded:
+            raise ValueError("overlay buffer of %d bytes, %d expected" % (len(source), padded))
+        renderer = SimRenderer(source, size, layer, alpha)
+        self.overlays.append(renderer)
+        return renderer
+
+    def remove_overlay(self, renderer):
+        self.overlays.remove(renderer)
+
+    def capture(self, output, format='jpeg', use_video_port=False, **kwargs):
+        sleep(settings['capture_time'])
+        locked = self.sensor_mode and self.exposure_mode == 'off' and self.awb_mode == 'off'
+        if not use_video_port and not locked:
+            sleep(settings['mode_switch_time'])
+        resolution = tuple(self.resolution)
+        if resolution not in self.jpegs:
+            # noise compresses about as badly as a real photo
+            img = Image.merge('RGB', [Image.effect_noise(resolution, 40) for _ in range(3)])
+            stream = io.BytesIO()
+            img.save(stream, 'JPEG', quality=85)
+            self.jpegs[resolution] = stream.getvalue()
+        if hasattr(output, 'write'):
+            output.write(self.jpegs[resolution])
+        else:
+            with open(output, 'wb') as target:
+                target.write(self.jpegs[resolution])
+        self.captures += 1
+
+    def close(self):
+        self.stop_preview()
@@ -0,0 +1,76 @@
+'''
+Timing of the startup phases of the photobooth.
+
+Import this module before anything else, so the time of the imports is measured as well.
+Every phase is logged when it ends, report() logs all of them with the time since
+the process was started and since the boot.
+'''
+
+import os
+from time import time
+
+
+def process_start():
+    ''' returns (time when the process was started, seconds from boot to process start) '''
+    now = time()
+    try:
+        with open('/proc/uptime', 'r') as uptime:
+            since_boot = float(uptime.read().split()[0])
+        with open('/proc/self/stat', 'r') as stat:
+            # the process name in brackets may contain spaces
+            fields = stat.read().rsplit(')', 1)[1].split()
+        started = float(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return now - (since_boot - started), started
+    except (OSError, ValueError, IndexError):
+        return now, None
+
+
+class StartupTimer:
+    ''' records the time of consecutive startup phases
+
+    Attributes
+    ------------
+    start : float
+        time when the process was started
+    boot_offset : float
+        seconds between boot and process start, None if unknown
+    phases : list
+        (phase name, time) tuples in the order of marking
+    reported : bool
+        whether the report was already written
+
+    Methods
+    ------------
+    mark(phase)
+        records the end of the phase
+    report()
+        logs the times of all the phases recorded so far, once
+    '''
+
+    def __init__(self):
+        self.start, self.boot_offset = process_start()
+        self.phases = []
+        self.reported = False
+
+    def mark(self, phase):
+        now = time()
+        self.phases.append((phase, now))
+        # logging is imported here, so its import is not counted before the first phase
+        from photologging import Logging
+        Logging('startup', console=False).append("%s: %.3f s" % (phase, now - self.start))
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        from photologging import Logging
+        log = Logging('startup')
+        if self.boot_offset is not None:
+            log.append("process started %.3f s after boot" % self.boot_offset)
+        previous = self.start
+        for (phase, moment) in self.phases:
+            log.append("%-24s %8.3f s %8.3f s" % (phase, moment - self.start, moment - previous))
+            previous = moment
+
+
+timer = StartupTimer()
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+Supervisor of the photobooth processes: the sender, the reset button watcher and the GUI.
+
+Starts them as child processes in this order and restarts a process that exits, after a delay growing
+with its failures in a row (reset once it ran for stable_time). Every report_interval logs and exports
+whether each process is up, its RSS and its CPU use, read from /proc.
+A second supervisor started meanwhile exits at once, so the script can be run on every login.
+On SIGTERM or SIGINT the processes are stopped in the reverse order, each with SIGTERM and given
+stop_timeout seconds before SIGKILL, so the GUI hands over its last session before the sender flushes
+the messages in progress.
+Usage: DISPLAY=:0.0 ./supervisor.py
+'''
+
+import fcntl
+import os
+import signal
+import subprocess
+import sys
+from time import sleep, time
+
+import photoconf
+import photologging
+import photometrics
+from photologging import Logging
+from photometrics import metrics
+from sendphotos import backoff
+
+log = Logging()
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def proc_stats(pid):
+    ''' returns (RSS in bytes, CPU seconds) of the process from /proc, or None when it is gone '''
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as stream:
+            # the command name in parentheses may contain spaces
+            fields = stream.read().rsplit(')', 1)[1].split()
+        with open('/proc/%d/status' % pid, 'r') as stream:
+            rss = [line for line in stream if line.startswith('VmRSS:')]
+    except (OSError, IndexError):
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    return (int(rss[0].split()[1]) * 1024 if rss else 0, cpu)
+
+
+class Child:
+    ''' one supervised process
+
+    Attributes
+    ------------
+    name : str
+        name in the log and in the metrics
+    args : list
+        command line of the process
+    process : subprocess.Popen
+        running process, None while waiting for a restart
+    started : float
+        time of the last start
+    failures : int
+        exits in a row that happened before stable_time
+    next_start : float
+        time of the next start
+    cpu : tuple
+        (time, CPU seconds) of the last report
+
+    Methods
+    ------------
+    start()
+        starts the process
+    alive()
+        returns True when the process is running
+    stop(timeout)
+        stops the process with SIGTERM and kills it after timeout seconds
+    '''
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.process = None
+        self.started = 0.0
+        self.failures = 0
+        self.next_start = 0.0
+        self.cpu = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.started = time()
+        self.cpu = None
+        metrics.inc(self.name + '_starts')
+        log.append("%s started, pid %d" % (self.name, self.process.pid))
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout):
+        if not self.alive():
+            return
+        log.append("stopping " + self.name)
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            log.append("%s killed after %.0f s" % (self.name, timeout))
+            self.process.kill()
+            self.process.wait()
+        log.append("%s stopped with code %d" % (self.name, self.process.returncode))
+
+
+class Supervisor:
+    ''' starts, restarts, reports and stops the children
+
+    Attributes
+    ------------
+    config : dict
+        "supervisor" part of the config
+    children : list
+        Child instances in the order of starting
+
+    Methods
+    ------------
+    check()
+        restarts the children that exited once their delay passed
+    report()
+        logs the liveness, RSS and CPU use of the children
+    run()
+        supervises until SIGTERM or SIGINT, then stops the children in reverse order
+    '''
+
+    def __init__(self, config=None):
+        if not config:
+            config = photoconf.load()
+            photoconf.watch()
+        self.config = config['supervisor']
+        photologging.configure(**config['logging'])
+        self.metricsdir = config['paths']['metrics']
+        self.lockpath = config['paths']['supervisor_lock']
+        self.metrics_config = config.get('metrics', {})
+        path = os.path.dirname(os.path.realpath(__file__))
+        self.children = [Child(name, [sys.executable, os.path.join(path, script)])
+                         for (name, script) in [('sender', 'sendphotos.py'), ('reset', 'shutdown_reset.py'),
+                                                ('gui', 'photoboothQt.py')]]
+        self.stopping = False
+
+    def check(self):
+        now = time()
+        for child in self.children:
+            if child.alive():
+                continue
+            if child.process is not None:
+                ran = now - child.started
+                log.append("%s exited with code %d after %.0f s" % (child.name, child.process.returncode, ran))
+                metrics.inc(child.name + '_exits')
+                child.failures = 1 if ran >= self.config['stable_time'] else child.failures + 1
+                child.next_start = now + backoff(child.failures - 1, self.config['restart_delay'],
+                                                 self.config['restart_max_delay'])
+                child.process = None
+            if now >= child.next_start:
+                try:
+                    child.start()
+                except OSError as e:
+                    log.append("%s not started: %s" % (child.name, e))
+                    child.failures += 1
+                    child.next_start = now + backoff(child.failures - 1, self.config['restart_delay'],
+                                                     self.config['restart_max_delay'])
+
+    def report(self):
+        now = time()
+        lines = []
+        for child in self.children:
+            stats = proc_stats(child.process.pid) if child.alive() else None
+            if stats is None:
+                lines.append("%s down" % child.name)
+                metrics.set(child.name + '_up', 0)
+                continue
+            (rss, cpu) = stats
+            share = 0.0
+            if child.cpu:
+                share = (cpu - child.cpu[1]) / max(0.001, now - child.cpu[0]) * 100
+            child.cpu = (now, cpu)
+            lines.append("%s up %.0f s, %.1f MB, %.1f%% CPU" % (child.name, now - child.started,
+                                                                rss / 1048576.0, share))
+            metrics.set(child.name + '_up', 1)
+            metrics.set(child.name + '_rss_bytes', rss)
+            metrics.set(child.name + '_cpu_percent', share)
+        log.append("; ".join(lines))
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        if not os.path.exists(os.path.dirname(self.lockpath)):
+            os.makedirs(os.path.dirname(self.lockpath))
+        lock = open(self.lockpath, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            log.append("supervisor already running")
+            return
+        photometrics.start_export(self.metrics_config, 'supervisor', self.metricsdir)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        last_report = 0.0
+        while not self.stopping:
+            self.check()
+            if time() - last_report >= self.config['report_interval']:
+                self.report()
+                last_report = time()
+            sleep(self.config['poll_interval'])
+        # the GUI hands over its session before the sender stops
+        for child in reversed(self.children):
+            child.stop(self.config['stop_timeout'])
+        log.append("supervisor stopped")
+
+
+if __name__ == '__main__':
+    Supervisor().run()